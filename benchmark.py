@@ -0,0 +1,836 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import random
+import threading
+import itertools
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Бенчмарки бота против локальной заглушки Bot API.
+# Запуск: python benchmark.py http --requests 2000 --threads 8
+#         python benchmark.py explain --rows 1000000
+#         python benchmark.py time --renders 100000
+#         python benchmark.py json --recipients 10000
+#         python benchmark.py index --edges 2000000
+#         python benchmark.py writes --changes 20000 --threads 16
+#         python benchmark.py retention --rows 1000000 --days 365
+#         python benchmark.py load --mode polling --owners 200 --subscribers 5000 --updates 20000
+
+# ========== ЗАГЛУШКА BOT API ==========
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят одним пакетом, без задержек Nagle/delayed ACK
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(200, {"ok": True, "result": True})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        api = getattr(self.server, "api", None)
+        if api is None:
+            self._reply(200, {"ok": True, "result": {"message_id": 1}})
+            return
+        method = self.path.rsplit("/", 1)[-1]
+        self._reply(*api.handle(method, json.loads(raw) if raw else {}))
+
+# Поведение заглушки для нагрузочных прогонов: задержка ответа, доля 429
+# и 5xx, очередь для getUpdates. Случайность от seed, чтобы прогоны повторялись
+class FakeBotAPI:
+    # Длинный опрос короче настоящего, чтобы бот быстро замечал остановку
+    LONG_POLL_LIMIT = 1.0
+
+    def __init__(self, latency=0.0, rate_429=0.0, error_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.cond = threading.Condition()
+        self.updates = []
+        self.delivered = {}
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    def push_updates(self, updates):
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def get_updates(self, payload):
+        offset = payload.get("offset", 0)
+        limit = payload.get("limit", 100)
+        deadline = time.monotonic() + min(payload.get("timeout", 0), self.LONG_POLL_LIMIT)
+        with self.cond:
+            while True:
+                # Как в Telegram: offset подтверждает все обновления до него
+                confirmed = 0
+                while confirmed < len(self.updates) and self.updates[confirmed]["update_id"] < offset:
+                    confirmed += 1
+                del self.updates[:confirmed]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = self.updates[:limit]
+            now = time.monotonic()
+            for update in batch:
+                self.delivered.setdefault(update["update_id"], now)
+        return batch
+
+    def handle(self, method, payload):
+        if method == "getUpdates":
+            self.calls[method] += 1
+            return 200, {"ok": True, "result": self.get_updates(payload)}
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self.cond:
+            roll = self.random.random()
+            if roll < self.rate_429:
+                outcome = "429"
+            elif roll < self.rate_429 + self.error_rate:
+                outcome = "500"
+            else:
+                outcome = "ok"
+            self.calls[method, outcome] += 1
+
+        if outcome == "429":
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        if outcome == "500":
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        if method == "answerCallbackQuery":
+            return 200, {"ok": True, "result": True}
+        return 200, {"ok": True, "result": {"message_id": next(self.message_ids),
+                                            "chat": {"id": payload.get("chat_id")}}}
+
+def start_fake_api(api=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPIHandler)
+    server.daemon_threads = True
+    server.api = api
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def import_bot(api_url):
+    # Конфигурация бота читается при импорте, поэтому окружение готовим заранее
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ.setdefault("BOT_TOKEN", "123:bench")
+    os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    import logging
+    logging.getLogger("bot").setLevel(logging.WARNING)
+    return bot
+
+# ========== ИЗМЕРЕНИЯ ==========
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_load(func, requests_count, threads):
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(requests_count)))
+    total = time.perf_counter() - start
+    return requests_count / total, percentile(latencies, 50), percentile(latencies, 99)
+
+def report(name, result):
+    rate, p50, p99 = result
+    print(f"{name:<28} {rate:>10.0f} req/s   p50 {p50 * 1000:>7.2f} ms   p99 {p99 * 1000:>7.2f} ms")
+
+# ========== СЦЕНАРИИ ==========
+def bench_http(args):
+    server, base_url = start_fake_api()
+    bot = import_bot(base_url)
+    url = bot.api_url("sendMessage")
+    payload = {"chat_id": 1, "text": "🟢 <b>Статус</b>", "parse_mode": "HTML"}
+
+    def fresh_connection():
+        req = urllib.request.Request(
+            url,
+            data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        json.loads(urllib.request.urlopen(req, timeout=8).read().decode())
+
+    def pooled_connection():
+        bot.safe_request(url, payload, "POST")
+
+    report("urllib (новое соединение)", run_load(fresh_connection, args.requests, args.threads))
+    report("safe_request (пул)", run_load(pooled_connection, args.requests, args.threads))
+    server.shutdown()
+
+# Горячие запросы и фрагмент плана, который каждый из них обязан содержать.
+# Полный проход по таблице без индекса считается регрессией, если запрос
+# не помечен как проход по маленькой или целиком нужной таблице
+HOT_QUERIES = [
+    ("get_subscriber_count",
+     "SELECT count FROM subscriber_counts WHERE target_user_id = ?", (1,),
+     "INTEGER PRIMARY KEY", False),
+    ("notify_subscribers",
+     "SELECT subscriber_id FROM subscriptions WHERE target_user_id = ?", (1,),
+     "idx_subscriptions_target_subscriber", False),
+    ("subscribe_to_server.conflict",
+     "SELECT 1 FROM subscriptions WHERE subscriber_id = ? AND target_user_id = ?", (1, 2),
+     "idx_subscriptions_subscriber_target", False),
+    ("unsubscribe_from_server",
+     "DELETE FROM subscriptions WHERE subscriber_id = ? AND target_user_id = ?", (1, 2),
+     "idx_subscriptions_subscriber_target", False),
+    ("unsubscribe_from_all.counts",
+     "SELECT target_user_id FROM subscriptions WHERE subscriber_id = ?", (1,),
+     "idx_subscriptions_subscriber_target", False),
+    ("update_server_status.previous",
+     "SELECT status FROM current_status WHERE user_id = ?", (1,),
+     "INTEGER PRIMARY KEY", False),
+    ("delete_user_data.history",
+     "DELETE FROM server_statuses WHERE user_id = ?", (1,),
+     "idx_server_statuses_user_created", False),
+    ("get_all_users",
+     "SELECT u.*, cs.status as last_status, COALESCE(sc.count, 0) as subscribers_count "
+     "FROM users u "
+     "LEFT JOIN current_status cs ON cs.user_id = u.user_id "
+     "LEFT JOIN subscriber_counts sc ON sc.target_user_id = u.user_id", (),
+     "INTEGER PRIMARY KEY", True),
+    ("show_stats",
+     "SELECT status, count FROM status_counters", (),
+     "status_counters", True),
+]
+
+def fill_synthetic_data(conn, rows, owners):
+    conn.executemany(
+        "INSERT INTO users (user_id, group_id, message_id, group_name) VALUES (?, ?, ?, ?)",
+        ((user_id, -100000 - user_id, 1, f"Группа {user_id}") for user_id in range(1, owners + 1))
+    )
+    statuses = ["status_on", "status_pause", "status_off", "status_unknown"]
+    conn.executemany(
+        "INSERT INTO server_statuses (user_id, status, created_at) VALUES (?, ?, datetime('now', ?))",
+        ((random.randint(1, owners), random.choice(statuses), f"-{i} seconds") for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (subscriber_id, target_user_id) VALUES (?, ?)",
+        ((random.randint(1, rows), random.randint(1, owners)) for _ in range(rows))
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO current_status (user_id, status, updated_at) "
+        "SELECT user_id, status, created_at FROM server_statuses "
+        "WHERE id IN (SELECT MAX(id) FROM server_statuses GROUP BY user_id)"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO subscriber_counts (target_user_id, count) "
+        "SELECT target_user_id, COUNT(*) FROM subscriptions GROUP BY target_user_id"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO status_counters (status, count) "
+        "SELECT status, COUNT(*) FROM current_status GROUP BY status"
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+
+def bench_explain(args):
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    conn = bot.get_db_connection()
+    start = time.perf_counter()
+    fill_synthetic_data(conn, args.rows, args.owners)
+    print(f"Синтетические данные: {args.rows} строк за {time.perf_counter() - start:.1f} с")
+
+    failures = 0
+    for name, sql, params, expected, allow_scan in HOT_QUERIES:
+        plan = " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        uses_index = expected in plan
+        full_scan = not allow_scan and any(
+            detail.startswith("SCAN") and "INDEX" not in detail
+            for detail in plan.split(" | ")
+        )
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        conn.rollback()
+        elapsed = (time.perf_counter() - start) * 1000
+        ok = uses_index and not full_scan
+        failures += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {name:<30} {elapsed:>8.2f} ms   {plan}")
+
+    if failures:
+        print(f"❌ Регрессий плана запросов: {failures}")
+        sys.exit(1)
+    print("✅ Все горячие запросы используют индексы")
+
+def bench_time(args):
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    from datetime import datetime
+    timezones = ["Asia/Yekaterinburg", "Europe/Moscow", "UTC", "America/New_York"]
+    
+    def uncached(timezone_str):
+        # Прежний путь: объект пояса и строка времени создаются на каждый вызов
+        tz = bot.pytz.timezone(timezone_str) if bot.pytz else bot.ZoneInfo(timezone_str)
+        return datetime.now(tz).strftime(bot.TIME_FORMAT)
+    
+    # На одно отображение меню статуса время форматируется примерно три раза
+    for name, func in (("без кэша", uncached), ("format_current_time", bot.format_current_time)):
+        start = time.perf_counter()
+        for i in range(args.renders):
+            timezone_str = timezones[i % len(timezones)]
+            for _ in range(3):
+                func(timezone_str)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {elapsed / args.renders * 1e6:>8.2f} мкс на отображение")
+
+def bench_json(args):
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    print(f"Кодировщик: {'orjson' if bot.orjson else 'json'}")
+    text = bot.render_status_notification(
+        server_info="Сервер", owner="Группа", label=bot.STATUS_LABELS["status_on"], time=bot.format_current_time("UTC"))
+    
+    def per_recipient():
+        # Прежний путь: полный json.dumps на каждого получателя
+        for chat_id in range(args.recipients):
+            payload = bot.build_message_payload(chat_id, text, bot.MAIN_MENU_BUTTONS)
+            payload["reply_markup"] = {"inline_keyboard": list(bot.MAIN_MENU_BUTTONS)}
+            json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    
+    def encoded_once():
+        body = bot.encode_payload({"text": text, "parse_mode": "HTML", "reply_markup": bot.MAIN_MENU_BUTTONS.markup})
+        for chat_id in range(args.recipients):
+            bot.with_chat_id(body, chat_id)
+    
+    # Ответ getUpdates на 100 обновлений, как при длинном опросе под нагрузкой
+    updates = [
+        {"update_id": i, "callback_query": {"id": str(i), "from": {"id": i, "first_name": "Тест"},
+                                            "message": {"message_id": i, "chat": {"id": i}, "text": text},
+                                            "data": "status_on"}}
+        for i in range(100)
+    ]
+    raw = json.dumps({"ok": True, "result": updates}, ensure_ascii=False).encode('utf-8')
+    batches = max(1, args.recipients // 100)
+    
+    def decode_stdlib():
+        for _ in range(batches):
+            json.loads(raw.decode())
+    
+    def decode_current():
+        for _ in range(batches):
+            bot.decode_json(raw)
+    
+    for name, func, count in (
+        ("json.dumps на получателя", per_recipient, args.recipients),
+        ("encode_payload + chat_id", encoded_once, args.recipients),
+        ("json.loads getUpdates", decode_stdlib, batches),
+        ("decode_json getUpdates", decode_current, batches),
+    ):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<28} {elapsed / count * 1e6:>8.2f} мкс на запрос")
+
+def bench_index(args):
+    import tracemalloc
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    conn = bot.get_db_connection()
+    start = time.perf_counter()
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (subscriber_id, target_user_id) VALUES (?, ?)",
+        ((random.randint(1, args.edges), random.randint(1, args.targets)) for _ in range(args.edges))
+    )
+    conn.commit()
+    edges = conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+    print(f"Связей в subscriptions: {edges} ({time.perf_counter() - start:.1f} с)")
+    
+    index = bot.SubscriptionIndex(refresh=0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    index.load()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"Загрузка индекса: {elapsed:.2f} с, память {memory / 1024 / 1024:.1f} МБ")
+    
+    targets = [random.randint(1, args.targets) for _ in range(args.lookups)]
+    for name, func in (
+        ("COUNT(*) в базе", lambda target: conn.execute(
+            "SELECT COUNT(*) FROM subscriptions WHERE target_user_id = ?", (target,)).fetchone()),
+        ("subscriber_count", index.subscriber_count),
+        ("подписчики из базы", lambda target: conn.execute(
+            "SELECT subscriber_id FROM subscriptions WHERE target_user_id = ?", (target,)).fetchall()),
+        ("subscribers", index.subscribers),
+    ):
+        start = time.perf_counter()
+        for target in targets:
+            func(target)
+        print(f"{name:<28} {(time.perf_counter() - start) / len(targets) * 1e6:>8.2f} мкс на запрос")
+
+def bench_writes(args):
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    statuses = ["status_on", "status_pause", "status_off"]
+    counter = itertools.count()
+    
+    def next_change():
+        i = next(counter)
+        return i % args.owners + 1, statuses[i % len(statuses)]
+    
+    def commit_per_change():
+        # Прежний путь: своя транзакция и COMMIT на каждое нажатие
+        user_id, status = next_change()
+        conn = bot.get_db_connection()
+        bot.record_status_change(conn, user_id, status)
+        conn.commit()
+    
+    def group_commit():
+        user_id, status = next_change()
+        bot.db_writer.call(bot.record_status_change, user_id, status).result()
+    
+    report("COMMIT на изменение", run_load(commit_per_change, args.changes, args.threads))
+    report("db_writer", run_load(group_commit, args.changes, args.threads))
+    batches = sum(sum(counts) for counts, _ in bot.db_write_batch.series.values())
+    print(f"Средний размер пачки писателя: {args.changes / max(1, batches):.1f} записей")
+
+def database_size(bot, conn):
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return os.path.getsize(bot.DATABASE_PATH) / 1024 / 1024
+
+def status_time(bot, conn, user_id, period, start, end):
+    # Чтение сверток: {bucket_start: {status: seconds}} по корзинам period в [start, end),
+    # end - не позже границы ретенции. Остаток корзины и корзины без переходов
+    # достаются статусу, закрывшему предыдущую корзину
+    size = dict(bot.ROLLUP_PERIODS)[period]
+    start -= start % size
+    
+    stored = {}
+    closings = {}
+    for row in conn.execute('''
+        SELECT bucket_start, status, seconds, closing FROM status_rollups
+        WHERE user_id = ? AND period = ? AND bucket_start >= ? AND bucket_start < ?
+    ''', (user_id, period, start, end)):
+        stored.setdefault(row['bucket_start'], {})[row['status']] = row['seconds']
+        if row['closing']:
+            closings[row['bucket_start']] = row['status']
+    
+    # Статус на начало диапазона закрыл последнюю корзину перед ним; если
+    # переходы до него свернуты сразу в суточные корзины, его знает суточная
+    previous = conn.execute('''
+        SELECT status FROM status_rollups
+        WHERE user_id = ? AND period = ? AND bucket_start < ? AND closing = 1
+        ORDER BY bucket_start DESC LIMIT 1
+    ''', (user_id, period, start)).fetchone()
+    if not previous and period == "hour":
+        previous = conn.execute('''
+            SELECT status FROM status_rollups
+            WHERE user_id = ? AND period = 'day' AND bucket_start < ? AND closing = 1
+            ORDER BY bucket_start DESC LIMIT 1
+        ''', (user_id, start - start % bot.DAY)).fetchone()
+    current = previous['status'] if previous else None
+    carry = conn.execute('SELECT status, since FROM status_rollup_carry WHERE user_id = ?', (user_id,)).fetchone()
+    
+    buckets = {}
+    for bucket in range(start, end, size):
+        stop = min(bucket + size, end)
+        times = dict(stored.get(bucket, {}))
+        if carry and bucket <= carry['since'] < stop:
+            # Открытый отрезок последнего свернутого перехода
+            times[carry['status']] = times.get(carry['status'], 0) + stop - carry['since']
+        # Остаток корзины - время до ее первого перехода или вся корзина без переходов
+        rest = stop - bucket - sum(times.values())
+        if current and rest > 0:
+            times[current] = times.get(current, 0) + rest
+        # Нулевые отрезки - переходы в одну секунду, времени в них нет
+        times = {status: seconds for status, seconds in times.items() if seconds}
+        if carry and bucket <= carry['since'] < stop:
+            current = carry['status']
+        else:
+            current = closings.get(bucket, current)
+        if times:
+            buckets[bucket] = times
+    return buckets
+
+def bench_retention(args):
+    # Фоновый проход бота не должен вмешиваться в измеряемый
+    os.environ["RETENTION_INTERVAL"] = "0"
+    bot = import_bot(os.environ.get("TELEGRAM_API_URL", "http://127.0.0.1:9"))
+    conn = bot.get_db_connection()
+    statuses = ["status_on", "status_pause", "status_off"]
+    now = int(time.time())
+    start_at = now - args.days * bot.DAY
+    
+    # Нажатия равномерно по времени, строки вставляются в порядке времени, как их пишет бот
+    clicks = sorted(
+        (random.randint(start_at, now), random.randint(1, args.owners), random.choice(statuses))
+        for _ in range(args.rows)
+    )
+    start = time.perf_counter()
+    conn.executemany(
+        "INSERT INTO server_statuses (user_id, status, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+        ((user_id, status, at) for at, user_id, status in clicks)
+    )
+    conn.commit()
+    size_before = database_size(bot, conn)
+    print(f"История: {args.rows} строк за {args.days} дней ({time.perf_counter() - start:.1f} с), "
+          f"база {size_before:.1f} МБ")
+    
+    start = time.perf_counter()
+    rolled, pruned, pages = bot.retention_engine.run_once(now)
+    elapsed = time.perf_counter() - start
+    size_after = database_size(bot, conn)
+    remaining = conn.execute("SELECT COUNT(*) FROM server_statuses").fetchone()[0]
+    rollups = conn.execute("SELECT period, COUNT(*) FROM status_rollups GROUP BY period").fetchall()
+    print(f"Ретенция: {elapsed:.1f} с, свернуто {rolled}, осталось {remaining}, "
+          f"освобождено страниц {pages}, база {size_after:.1f} МБ")
+    print("Свертки: " + ", ".join(f"{row[0]} {row[1]}" for row in rollups))
+    failed = False
+    
+    # Свертка не должна раздувать базу: строк в ней не больше, чем переходов
+    print(f"{'✅' if size_after <= size_before else '❌'} База после прохода: "
+          f"{size_before:.1f} -> {size_after:.1f} МБ")
+    failed |= size_after > size_before
+    
+    # Проверка: время по корзинам, восстановленное status_time, совпадает
+    # с переходами из истории до границы, включая корзины без переходов
+    cutoff = now - int(bot.STATUS_RETENTION_DAYS * bot.DAY)
+    cutoff -= cutoff % bot.HOUR
+    hourly_since = now - int(bot.ROLLUP_HOURLY_DAYS * bot.DAY)
+    hourly_since -= hourly_since % bot.DAY
+    transitions = {}
+    for at, user_id, status in clicks:
+        if at >= cutoff:
+            break
+        owner = transitions.setdefault(user_id, [])
+        if not owner or owner[-1][1] != status:
+            owner.append((at, status))
+    
+    def expected_time(owner, size, since):
+        buckets = {}
+        for (at, status), (stop, _) in zip(owner, owner[1:] + [(cutoff, None)]):
+            at = max(at, since)
+            while at < stop:
+                bucket = at - at % size
+                end = min(stop, bucket + size)
+                times = buckets.setdefault(bucket, {})
+                times[status] = times.get(status, 0) + end - at
+                at = end
+        return buckets
+    
+    for period, size, since, owners in (
+        ("day", bot.DAY, start_at, sorted(transitions)),
+        ("hour", bot.HOUR, hourly_since, sorted(transitions)[:args.hourly_owners]),
+    ):
+        mismatches = sum(
+            status_time(bot, conn, user_id, period, since, cutoff) != expected_time(transitions[user_id], size, since)
+            for user_id in owners
+        )
+        print(f"{'✅' if not mismatches else '❌'} Корзины '{period}' сходятся с историей: "
+              f"расхождений {mismatches} из {len(owners)} владельцев")
+        failed |= mismatches > 0
+    
+    actual_transitions = dict(conn.execute(
+        "SELECT user_id, SUM(transitions) FROM status_rollups WHERE period = 'day' GROUP BY user_id").fetchall())
+    mismatches = sum(actual_transitions.get(user_id) != len(owner) for user_id, owner in transitions.items())
+    print(f"{'✅' if not mismatches else '❌'} Переходы в суточных свертках: "
+          f"расхождений {mismatches} из {len(transitions)} владельцев")
+    failed |= mismatches > 0
+    if failed:
+        sys.exit(1)
+
+# ========== НАГРУЗОЧНЫЙ ПРОГОН ==========
+# Доли нажатий: владельцы переключают статус и ходят по меню,
+# подписчики смотрят статистику. Подписки через кнопки не генерируются:
+# меню подписок в боте пока не реализовано
+OWNER_CLICKS = (
+    ("callback", "status_on", 20), ("callback", "status_pause", 10), ("callback", "status_off", 10),
+    ("callback", "manage_status", 20), ("callback", "back_to_main", 20), ("callback", "stats", 10),
+    ("message", "/stats", 10),
+)
+SUBSCRIBER_CLICKS = (
+    ("callback", "stats", 40), ("callback", "back_to_main", 30), ("message", "/stats", 20),
+    ("message", "привет", 10),
+)
+OWNER_SHARE = 0.5
+OUTBOUND_LIMIT_SETTINGS = (
+    "OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_CHAT_BURST", "OUTBOUND_GROUP_PER_MINUTE",
+)
+
+def setup_load_data(bot, owners, subscribers, follows, rng):
+    owner_ids = list(range(1, owners + 1))
+    subscriber_ids = list(range(owners + 1, owners + subscribers + 1))
+    for user_id in owner_ids:
+        bot.setup_user_settings(user_id, -100000 - user_id, None, 1, f"Группа {user_id}", f"Сервер {user_id}")
+    
+    # Популярность владельцев по Ципфу: у первых тысячи подписчиков, у хвоста единицы
+    weights = [1 / rank for rank in range(1, owners + 1)]
+    conn = bot.get_db_connection()
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (subscriber_id, target_user_id) VALUES (?, ?)",
+        ((subscriber_id, target_user_id) for subscriber_id in subscriber_ids
+         for target_user_id in set(rng.choices(owner_ids, weights, k=follows)))
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO subscriber_counts (target_user_id, count) "
+        "SELECT target_user_id, COUNT(*) FROM subscriptions GROUP BY target_user_id"
+    )
+    conn.commit()
+    bot.subscription_index.load()
+    return owner_ids, subscriber_ids
+
+def make_update(update_id, user_id, kind, value):
+    sender = {"id": user_id, "first_name": "Тест"}
+    if kind == "callback":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": sender, "data": value,
+            "message": {"message_id": 1, "chat": {"id": user_id, "type": "private"}}}}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "from": sender, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"}, "text": value}}
+
+def generate_updates(count, owner_ids, subscriber_ids, rng):
+    owner_clicks = [(kind, value) for kind, value, _ in OWNER_CLICKS]
+    owner_weights = [weight for _, _, weight in OWNER_CLICKS]
+    subscriber_clicks = [(kind, value) for kind, value, _ in SUBSCRIBER_CLICKS]
+    subscriber_weights = [weight for _, _, weight in SUBSCRIBER_CLICKS]
+    updates = []
+    for update_id in range(1, count + 1):
+        if not subscriber_ids or rng.random() < OWNER_SHARE:
+            user_id = rng.choice(owner_ids)
+            kind, value = rng.choices(owner_clicks, owner_weights)[0]
+        else:
+            user_id = rng.choice(subscriber_ids)
+            kind, value = rng.choices(subscriber_clicks, subscriber_weights)[0]
+        updates.append(make_update(update_id, user_id, kind, value))
+    return updates
+
+def feed_updates(updates, rate, push):
+    # rate <= 0 - все обновления сразу (пропускная способность),
+    # иначе равномерный поток с заданной частотой (задержка под нагрузкой)
+    if rate <= 0:
+        push(updates)
+        return
+    start = time.monotonic()
+    sent = 0
+    while sent < len(updates):
+        due = min(len(updates), int((time.monotonic() - start) * rate) + 1)
+        if due > sent:
+            push(updates[sent:due])
+            sent = due
+        else:
+            time.sleep(min(0.01, (due - (time.monotonic() - start) * rate) / rate))
+
+def drive_polling(bot, api, updates, rate):
+    bot.polling_stop.clear()
+    poller = threading.Thread(target=bot.run_polling_bot, name="polling", daemon=True)
+    poller.start()
+    feed_updates(updates, rate, api.push_updates)
+    
+    def stop():
+        bot.polling_stop.set()
+        poller.join()
+    return api.delivered, Counter(), stop
+
+def drive_webhook(bot, updates, rate, clients):
+    accepted = {}
+    statuses = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET}
+    
+    def post(update):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = bot.app.test_client()
+        body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+        while True:
+            started = time.monotonic()
+            status = client.post("/webhook", data=body, headers=headers, content_type="application/json").status_code
+            with lock:
+                statuses[status] += 1
+            if status != 503:
+                break
+            # Как Telegram: при переполнении очереди доставка повторяется позже
+            time.sleep(0.01)
+        with lock:
+            accepted[update["update_id"]] = started
+    
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        feed_updates(updates, rate, lambda batch: list(executor.map(post, batch)))
+    return accepted, statuses, lambda: None
+
+def snapshot_histogram(histogram):
+    with histogram.lock:
+        return {labels: (sum(counts), total) for labels, (counts, total) in histogram.series.items()}
+
+def bench_load(args):
+    if not args.real_limits:
+        # Лимиты Telegram в планировщике снимаются: меряется сам бот, а не ожидание токенов
+        for name in OUTBOUND_LIMIT_SETTINGS:
+            os.environ.setdefault(name, "1000000")
+    api = FakeBotAPI(args.api_latency / 1000, args.rate_429, args.error_rate, args.retry_after, args.seed)
+    server, base_url = start_fake_api(api)
+    bot = import_bot(base_url)
+    rng = random.Random(args.seed)
+    
+    start = time.perf_counter()
+    owner_ids, subscriber_ids = setup_load_data(bot, args.owners, args.subscribers, args.follows, rng)
+    updates = generate_updates(args.updates, owner_ids, subscriber_ids, rng)
+    print(f"Данные: {args.owners} владельцев, {args.subscribers} подписчиков, "
+          f"{len(updates)} обновлений ({time.perf_counter() - start:.1f} с)")
+    
+    done = {}
+    finished = threading.Event()
+    lock = threading.Lock()
+    process_update = bot.process_update
+    
+    def tracked_process_update(update, received_at=None):
+        try:
+            process_update(update, received_at)
+        finally:
+            with lock:
+                done[update["update_id"]] = time.monotonic()
+                if len(done) >= len(updates):
+                    finished.set()
+    
+    # Воркеры обновлений вызывают process_update через глобальное имя модуля
+    bot.process_update = tracked_process_update
+    db_before = snapshot_histogram(bot.db_latency)
+    calls_before = Counter(api.calls)
+    
+    start = time.monotonic()
+    if args.mode == "polling":
+        received, statuses, stop = drive_polling(bot, api, updates, args.rate)
+    else:
+        received, statuses, stop = drive_webhook(bot, updates, args.rate, args.clients)
+    if not finished.wait(args.timeout):
+        print(f"⚠️ За {args.timeout:.0f} с обработано {len(done)} из {len(updates)} обновлений")
+    with lock:
+        completed = dict(done)
+    elapsed = (max(completed.values()) - start) if completed else 0.0
+    stop()
+    
+    # Уведомления подписчиков уходят после окна склейки правок статуса
+    drain_start = time.monotonic()
+    while (bot.outbound_scheduler.pending or bot.status_edit_coalescer.pending) \
+            and time.monotonic() - drain_start < args.timeout:
+        time.sleep(0.05)
+    drain = time.monotonic() - start
+    
+    db_after = snapshot_histogram(bot.db_latency)
+    latencies = [completed[update_id] - received[update_id] for update_id in completed if update_id in received]
+    rate = len(completed) / elapsed if elapsed else 0.0
+    print(f"Режим {args.mode}: {len(completed)} обновлений за {elapsed:.2f} с, {rate:.0f} обн/с")
+    print(f"Задержка обработки          p50 {percentile(latencies, 50) * 1000:>8.2f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:>8.2f} ms")
+    print(f"Исходящие отправлены через  {drain:.2f} с от начала прогона")
+    if statuses:
+        print("Ответы вебхука: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    
+    statements = {}
+    for labels, (count, total) in db_after.items():
+        before_count, before_total = db_before.get(labels, (0, 0.0))
+        if count > before_count:
+            statements[labels[0]] = (count - before_count, total - before_total)
+    count = sum(count for count, _ in statements.values())
+    total = sum(total for _, total in statements.values())
+    per_update = max(1, len(completed))
+    print(f"БД: {count} выражений ({count / per_update:.1f} на обновление), "
+          f"{total * 1000:.0f} ms ({total * 1000 / per_update:.3f} ms на обновление)")
+    for statement, (count, total) in sorted(statements.items(), key=lambda item: -item[1][1])[:5]:
+        print(f"    {total * 1000:>8.1f} ms {count:>8} × {statement}")
+    
+    calls = Counter(api.calls)
+    calls.subtract(calls_before)
+    print("Bot API: " + ", ".join(
+        f"{key if isinstance(key, str) else ' '.join(key)}: {count}"
+        for key, count in sorted(calls.items(), key=lambda item: str(item[0])) if count))
+    server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота статусов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    http_parser = subparsers.add_parser("http", help="пул соединений safe_request против urllib")
+    http_parser.add_argument("--requests", type=int, default=2000)
+    http_parser.add_argument("--threads", type=int, default=8)
+    http_parser.set_defaults(func=bench_http)
+
+    explain_parser = subparsers.add_parser("explain", help="проверка EXPLAIN QUERY PLAN на синтетических данных")
+    explain_parser.add_argument("--rows", type=int, default=1000000)
+    explain_parser.add_argument("--owners", type=int, default=10000)
+    explain_parser.set_defaults(func=bench_explain)
+
+    time_parser = subparsers.add_parser("time", help="стоимость форматирования текущего времени на отображение")
+    time_parser.add_argument("--renders", type=int, default=100000)
+    time_parser.set_defaults(func=bench_time)
+
+    json_parser = subparsers.add_parser("json", help="кодирование тел запросов и разбор ответов при рассылке")
+    json_parser.add_argument("--recipients", type=int, default=10000)
+    json_parser.set_defaults(func=bench_json)
+
+    index_parser = subparsers.add_parser("index", help="память и скорость индекса подписок")
+    index_parser.add_argument("--edges", type=int, default=2000000)
+    index_parser.add_argument("--targets", type=int, default=10000)
+    index_parser.add_argument("--lookups", type=int, default=10000)
+    index_parser.set_defaults(func=bench_index)
+
+    writes_parser = subparsers.add_parser("writes", help="групповая запись истории статусов против COMMIT на изменение")
+    writes_parser.add_argument("--changes", type=int, default=20000)
+    writes_parser.add_argument("--threads", type=int, default=16)
+    writes_parser.add_argument("--owners", type=int, default=1000)
+    writes_parser.set_defaults(func=bench_writes)
+
+    retention_parser = subparsers.add_parser("retention", help="свертка и чистка истории статусов")
+    retention_parser.add_argument("--rows", type=int, default=1000000)
+    retention_parser.add_argument("--days", type=int, default=365)
+    retention_parser.add_argument("--owners", type=int, default=1000)
+    retention_parser.add_argument("--hourly-owners", type=int, default=50)
+    retention_parser.set_defaults(func=bench_retention)
+
+    load_parser = subparsers.add_parser("load", help="сквозной прогон polling или webhook против заглушки Bot API")
+    load_parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    load_parser.add_argument("--owners", type=int, default=200)
+    load_parser.add_argument("--subscribers", type=int, default=5000)
+    load_parser.add_argument("--follows", type=int, default=3, help="подписок у одного подписчика")
+    load_parser.add_argument("--updates", type=int, default=20000)
+    load_parser.add_argument("--rate", type=float, default=0, help="обновлений в секунду, 0 - все сразу")
+    load_parser.add_argument("--clients", type=int, default=4, help="параллельных отправителей вебхука")
+    load_parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа Bot API, мс")
+    load_parser.add_argument("--rate-429", type=float, default=0, help="доля ответов 429")
+    load_parser.add_argument("--error-rate", type=float, default=0, help="доля ответов 500")
+    load_parser.add_argument("--retry-after", type=int, default=1)
+    load_parser.add_argument("--seed", type=int, default=1)
+    load_parser.add_argument("--timeout", type=float, default=300)
+    load_parser.add_argument("--real-limits", action="store_true", help="оставить лимиты Telegram в планировщике")
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,42 @@
 import os
 from flask import Flask, request
-from threading import Thread
-import urllib.request
+from threading import Thread, Lock
+import threading
+import queue
+import asyncio
+import ssl
+import http.client
+import socket
 import urllib.parse
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import time
 import sqlite3
 from datetime import datetime
-import pytz
+try:
+    import pytz
+except ImportError:
+    pytz = None
+    from zoneinfo import ZoneInfo
 import logging
 import hashlib
 import secrets
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque, OrderedDict
+import heapq
+import bisect
+from array import array
+import itertools
 import re
+import contextvars
 
 # ========== ОБЯЗАТЕЛЬНО ДОБАВИТЬ В НАЧАЛО ==========
 # Эта строка читает порт, который дает Render
@@ -24,6 +48,56 @@ ADMIN_PASSWORD_HASH = os.environ.get("ADMIN_PASSWORD_HASH", "")
 ADMIN_USER_ID = int(os.environ.get("ADMIN_USER_ID", "0"))
 SECRET_KEY = os.environ.get("SECRET_KEY", secrets.token_hex(32))
 DATABASE_PATH = os.environ.get("DATABASE_PATH", "bot_database.db")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or f"webhook:{BOT_TOKEN}"
+# Telegram принимает secret_token только из A-Za-z0-9_- (до 256 символов),
+# поэтому произвольное значение превращаем в hex
+if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    WEBHOOK_SECRET = hashlib.sha256(WEBHOOK_SECRET.encode()).hexdigest()
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "8"))
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", "60"))
+RUNTIME_MODE = os.environ.get("RUNTIME_MODE", "threads")
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "256"))
+ASYNC_HANDLER_WORKERS = int(os.environ.get("ASYNC_HANDLER_WORKERS", "16"))
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "8"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.environ.get("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_GROUP_BURST = float(os.environ.get("OUTBOUND_GROUP_BURST", "1"))
+OUTBOUND_MAX_ATTEMPTS = int(os.environ.get("OUTBOUND_MAX_ATTEMPTS", "5"))
+OUTBOUND_WAIT_TIMEOUT = float(os.environ.get("OUTBOUND_WAIT_TIMEOUT", "60"))
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", "4"))
+STATUS_EDIT_WINDOW = float(os.environ.get("STATUS_EDIT_WINDOW", "1.5"))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "2"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_LEASE = float(os.environ.get("BROADCAST_LEASE", "300"))
+SUBSCRIPTION_INDEX_REFRESH = float(os.environ.get("SUBSCRIPTION_INDEX_REFRESH", "5"))
+SUBSCRIPTION_CHANGES_TTL = float(os.environ.get("SUBSCRIPTION_CHANGES_TTL", str(24 * 60 * 60)))
+UPDATE_CHECKPOINT_INTERVAL = float(os.environ.get("UPDATE_CHECKPOINT_INTERVAL", "1"))
+UPDATE_DEDUP_TTL = float(os.environ.get("UPDATE_DEDUP_TTL", str(24 * 60 * 60)))
+UPDATE_DEDUP_LIMIT = int(os.environ.get("UPDATE_DEDUP_LIMIT", "100000"))
+STATUS_RETENTION_DAYS = float(os.environ.get("STATUS_RETENTION_DAYS", "30"))
+ROLLUP_HOURLY_DAYS = float(os.environ.get("ROLLUP_HOURLY_DAYS", "90"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", "1000"))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "10"))
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_WRITE_BATCH = int(os.environ.get("DB_WRITE_BATCH", "256"))
+DB_WRITE_DELAY = float(os.environ.get("DB_WRITE_DELAY", "0"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "60"))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+STATE_TTL = float(os.environ.get("STATE_TTL", str(24 * 60 * 60)))
+ADMIN_SESSION_TTL = float(os.environ.get("ADMIN_SESSION_TTL", str(12 * 60 * 60)))
 
 # ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
 logging.basicConfig(
@@ -36,26 +110,145 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# ========== МЕТРИКИ ==========
+# Гистограммы в текстовом формате Prometheus без внешних зависимостей.
+# observe - бинарный поиск корзины и короткая блокировка, поэтому их можно
+# звать на каждом запросе к БД и Bot API. Метрики считаются по процессу:
+# при нескольких воркерах gunicorn каждый отдает свои
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+DB_STATEMENT_LABELS_LIMIT = 500
+WRITE_BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
 
-@app.route('/webhook', methods=['POST'])
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+    
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(values, list(counts), total) for values, (counts, total) in self.series.items()]
+        for values, counts, total in sorted(series):
+            labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, values))
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+update_latency = Histogram(
+    "bot_update_latency_seconds", "Время от получения обновления до конца обработки", ("type",))
+route_latency = Histogram(
+    "bot_route_seconds", "Время обработчика маршрута", ("route",))
+api_latency = Histogram(
+    "bot_api_request_seconds", "Время запроса к Bot API", ("method", "status"))
+db_latency = Histogram(
+    "bot_db_statement_seconds", "Время выполнения SQL-выражения", ("statement",), DB_BUCKETS)
+db_write_batch = Histogram(
+    "bot_db_write_batch_size", "Записей в одной транзакции писателя", (), WRITE_BATCH_BUCKETS)
+db_statement_labels = {}
+
+def db_statement_label(sql):
+    # Подпись - SQL без лишних пробелов; число разных подписей ограничено
+    label = db_statement_labels.get(sql)
+    if label is None:
+        if len(db_statement_labels) >= DB_STATEMENT_LABELS_LIMIT:
+            return "other"
+        label = db_statement_labels[sql] = " ".join(sql.split())[:120]
+    return label
+
+def observe_api_request(url, status, elapsed):
+    api_latency.observe(elapsed, url.rsplit("/", 1)[-1].split("?", 1)[0], str(status))
+
+def render_metrics():
+    lines = []
+    for histogram in (update_latency, route_latency, api_latency, db_latency, db_write_batch):
+        lines.extend(histogram.render())
+    gauges = [
+        ("bot_update_queue_depth", "Обновлений в очередях воркеров", get_update_queue_depth()),
+        ("bot_async_update_queue_depth", "Обновлений в очередях asyncio", sum(shard.qsize() for shard in async_update_shards)),
+        ("bot_outbound_pending", "Исходящих запросов в планировщике", outbound_scheduler.pending),
+        ("bot_status_edits_pending", "Правок сообщений статуса в окне склейки", len(status_edit_coalescer.pending)),
+        ("bot_user_cache_size", "Профилей в кэше", len(user_cache.entries)),
+        ("bot_db_writes_pending", "Записей в очереди писателя", len(db_writer.pending)),
+    ]
+    for name, help_text, value in gauges:
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
+
+app = Flask(__name__)
 
 @app.route('/')
 def home():
     return "🤖 Бот управления статусами работает!", 200
+
+@app.route('/metrics')
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not secrets.compare_digest(token, WEBHOOK_SECRET):
+        logger.warning("❌ Webhook с неверным секретным токеном")
+        return "Forbidden", 403
     
+    try:
+        update = decode_json(request.get_data())
+    except ValueError:
+        update = None
+    if not isinstance(update, dict):
+        return "Bad Request", 400
+    
+    # Отвечаем сразу, обработка идет в пуле воркеров.
+    # При переполнении очереди Telegram повторит доставку позже
+    ack = get_webhook_callback_ack(update)
+    if not enqueue_update(update):
+        logger.warning("⚠️ Очередь обновлений переполнена")
+        return "Busy", 503
+    if ack:
+        return ack, 200, {"Content-Type": "application/json"}
+    return "OK", 200
+
 app.secret_key = SECRET_KEY
 
 # ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
 bot_start_time = time.time()
 bot_enabled = True
 bot_disable_reason = ""
-user_states = {}
-admin_sessions = {}
+async_loop = None
+async_loop_thread_id = None
+# Установка события завершает цикл run_polling_bot после текущего getUpdates
+polling_stop = threading.Event()
 
 # ========== БАЗА ДАННЫХ ==========
 def init_db():
     conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    # Для новой базы режим действует сразу, старую переводит convert_auto_vacuum
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL сохраняется в файле базы: читатели не блокируют писателя
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -89,17 +282,425 @@ def init_db():
         )
     ''')
     
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            status TEXT DEFAULT 'pending',
+            total INTEGER DEFAULT 0,
+            cursor INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            lease_until REAL DEFAULT 0,
+            started_at REAL,
+            finished_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER,
+            user_id INTEGER,
+            outcome TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, user_id)
+        )
+    ''')
+    
     conn.commit()
+    apply_migrations(conn)
     conn.close()
     logger.info("✅ База данных инициализирована")
 
+# Версия схемы - PRAGMA user_version, каждая миграция идет в своей транзакции
+MIGRATIONS = [
+    (1, [
+        # Перед уникальным индексом убираем накопившиеся дубли подписок
+        '''
+        DELETE FROM subscriptions WHERE id NOT IN (
+            SELECT MIN(id) FROM subscriptions GROUP BY subscriber_id, target_user_id
+        )
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_subscriber_target ON subscriptions (subscriber_id, target_user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_target_subscriber ON subscriptions (target_user_id, subscriber_id)',
+        'CREATE INDEX IF NOT EXISTS idx_server_statuses_user_created ON server_statuses (user_id, created_at, status)',
+        'ANALYZE',
+    ]),
+    (2, [
+        # Текущий статус и счетчики пишутся в одной транзакции с историей
+        '''
+        CREATE TABLE IF NOT EXISTS current_status (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS status_counters (
+            status TEXT PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriber_counts (
+            target_user_id INTEGER PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO current_status (user_id, status, updated_at)
+        SELECT user_id, status, created_at FROM server_statuses
+        WHERE id IN (SELECT MAX(id) FROM server_statuses GROUP BY user_id)
+          AND user_id IN (SELECT user_id FROM users)
+        ''',
+        '''
+        INSERT OR REPLACE INTO status_counters (status, count)
+        SELECT status, COUNT(*) FROM current_status GROUP BY status
+        ''',
+        '''
+        INSERT OR REPLACE INTO subscriber_counts (target_user_id, count)
+        SELECT target_user_id, COUNT(*) FROM subscriptions GROUP BY target_user_id
+        ''',
+    ]),
+    (3, [
+        # Состояния диалогов и админ-сессии, общие для всех воркеров
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            namespace TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON conversation_state(expires_at)',
+    ]),
+    (4, [
+        # Подтвержденный offset getUpdates и уже взятые в обработку update_id
+        '''
+        CREATE TABLE IF NOT EXISTS update_offsets (
+            name TEXT PRIMARY KEY,
+            update_id INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            claimed_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_processed_updates_claimed ON processed_updates(claimed_at)',
+    ]),
+    (5, [
+        # Свертки истории по владельцу за час и за сутки (UTC); closing - статус на конце корзины
+        '''
+        CREATE TABLE IF NOT EXISTS status_rollups (
+            user_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            transitions INTEGER NOT NULL DEFAULT 0,
+            closing INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, period, bucket_start, status)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS status_rollup_carry (
+            user_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            since INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    (6, [
+        # Владелец аренды рассылки: курсор двигает только тот, кто ее держит
+        'ALTER TABLE broadcast_jobs ADD COLUMN lease_owner TEXT',
+    ]),
+    (7, [
+        # Журнал изменений подписок: по нему воркеры догоняют индексы в памяти
+        '''
+        CREATE TABLE IF NOT EXISTS subscription_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            second_id INTEGER,
+            created_at REAL NOT NULL
+        )
+        ''',
+    ]),
+]
+
+def apply_migrations(conn):
+    for version, statements in MIGRATIONS:
+        try:
+            # BEGIN IMMEDIATE не дает двум воркерам gunicorn мигрировать одновременно
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+            logger.info(f"🗄️ Схема базы обновлена до версии {version}")
+        except Exception:
+            conn.rollback()
+            raise
+
 init_db()
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+# Каждый поток держит одно долгоживущее соединение с кэшем подготовленных выражений
+db_local = threading.local()
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Время execute включает шаг до первой строки; дочитывание fetchall не входит
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            db_latency.observe(time.perf_counter() - start, db_statement_label(sql))
+    
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            db_latency.observe(time.perf_counter() - start, db_statement_label(sql))
+    
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            db_latency.observe(time.perf_counter() - start, "COMMIT")
+
+def open_db_connection():
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+        factory=InstrumentedConnection
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
     return conn
 
+def get_db_connection():
+    conn = getattr(db_local, 'conn', None)
+    # После fork (gunicorn --preload) соединение родителя использовать нельзя
+    if conn is None or db_local.pid != os.getpid():
+        conn = open_db_connection()
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    return conn
+
+def rollback_db_connection():
+    # Транзакция, брошенная из-за исключения, не должна держать блокировку записи
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# ========== ГРУППОВАЯ ЗАПИСЬ ==========
+# Один поток-писатель фиксирует записи обработчиков пачками, по COMMIT на пачку
+class GroupCommitWriter:
+    def __init__(self, batch_size=DB_WRITE_BATCH, delay=DB_WRITE_DELAY):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.cond = threading.Condition()
+        # (момент постановки, ("rows", sql, params) или ("call", func, args), Future)
+        self.pending = deque()
+        self.started = False
+    
+    def enqueue(self, item):
+        future = Future()
+        with self.cond:
+            self.pending.append((time.monotonic(), item, future))
+            if not self.started:
+                self.started = True
+                Thread(target=self.run, name="db-writer", daemon=True).start()
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return future
+    
+    def execute(self, sql, params=()):
+        return self.enqueue(("rows", sql, params))
+    
+    def call(self, func, *args):
+        # func(conn, *args) выполняется в транзакции писателя и сам к писателю не обращается
+        return self.enqueue(("call", func, args))
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Ждем попутчиков, пока самая старая запись не исчерпала бюджет задержки
+                deadline = self.pending[0][0] + self.delay
+                while len(self.pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            # Отмененные вызывающим записи не выполняем; остальные больше нельзя отменить
+            batch = [entry for entry in batch if entry[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self.commit_batch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка потока записи ({len(batch)} записей): {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+    
+    def steps(self, batch):
+        # Подряд идущие строки с одним SQL склеиваются в один шаг executemany
+        step = None
+        for _, (kind, target, args), future in batch:
+            if kind == "rows" and step and step[0] == "rows" and step[1] == target:
+                step[2].append(args)
+                step[3].append(future)
+                continue
+            if step:
+                yield step
+            step = (kind, target, [args], [future])
+        if step:
+            yield step
+    
+    def commit_batch(self, batch):
+        db_write_batch.observe(len(batch))
+        conn = None
+        results = []
+        try:
+            conn = get_db_connection()
+            conn.execute('BEGIN IMMEDIATE')
+            for kind, target, args, futures in self.steps(batch):
+                conn.execute('SAVEPOINT write_step')
+                try:
+                    if kind == "rows":
+                        conn.executemany(target, args)
+                        values = [None] * len(futures)
+                    else:
+                        values = [target(conn, *args[0])]
+                    conn.execute('RELEASE write_step')
+                    results.extend((future, value, None) for future, value in zip(futures, values))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_step')
+                    conn.execute('RELEASE write_step')
+                    results.extend((future, None, e) for future in futures)
+            conn.commit()
+        except Exception as e:
+            try:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+            except Exception as rollback_error:
+                # Соединение, которое не может откатиться, заменяем новым
+                logger.error(f"Ошибка отката групповой записи: {rollback_error}")
+                db_local.conn = None
+            logger.error(f"Ошибка групповой записи ({len(batch)} записей): {e}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for future, value, error in results:
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+db_writer = GroupCommitWriter()
+
+# ========== СОСТОЯНИЯ ДИАЛОГОВ ==========
+# Шаг диалога (waiting_timezone и т.п.) и админ-сессии живут в хранилище
+# с TTL. По умолчанию это SQLite: состояние переживает деплой и видно всем
+# воркерам gunicorn. STATE_BACKEND=memory оставляет его в памяти процесса.
+# Значение None равносильно удалению
+STATE_PRUNE_INTERVAL = 300
+
+class MemoryStateStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.values = {}
+        self.lock = Lock()
+        self.last_prune = time.time()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.time():
+                del self.values[key]
+                return default
+            return entry[0]
+    
+    def set(self, key, value):
+        if value is None:
+            self.delete(key)
+            return
+        now = time.time()
+        with self.lock:
+            self.values[key] = (value, now + self.ttl)
+            if now - self.last_prune > STATE_PRUNE_INTERVAL:
+                self.last_prune = now
+                for expired in [k for k, entry in self.values.items() if entry[1] <= now]:
+                    del self.values[expired]
+    
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+class SQLiteStateStore:
+    def __init__(self, namespace, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.last_prune = 0
+    
+    def get(self, key, default=None):
+        conn = get_db_connection()
+        row = conn.execute(
+            'SELECT value FROM conversation_state WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (self.namespace, key, time.time())
+        ).fetchone()
+        return decode_json(row['value']) if row else default
+    
+    def set(self, key, value):
+        if value is None:
+            self.delete(key)
+            return
+        db_writer.call(self.write, key, encode_json(value).decode('utf-8'), time.time()).result()
+    
+    def write(self, conn, key, value, now):
+        conn.execute('''
+            INSERT INTO conversation_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+        ''', (self.namespace, key, value, now + self.ttl))
+        if now - self.last_prune > STATE_PRUNE_INTERVAL:
+            self.last_prune = now
+            conn.execute('DELETE FROM conversation_state WHERE namespace = ? AND expires_at <= ?', (self.namespace, now))
+    
+    def delete(self, key):
+        db_writer.execute(
+            'DELETE FROM conversation_state WHERE namespace = ? AND key = ?', (self.namespace, key)
+        ).result()
+
+def create_state_store(namespace, ttl):
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore(ttl)
+    return SQLiteStateStore(namespace, ttl)
+
+user_states = create_state_store("user_state", STATE_TTL)
+admin_sessions = create_state_store("admin_session", ADMIN_SESSION_TTL)
+
 # ========== БЕЗОПАСНОСТЬ ==========
 def validate_input(text, max_length=1000):
     if not text or len(text) > max_length:
@@ -115,7 +716,7 @@ def authenticate_admin(user_id, password):
     
     password_hash = hashlib.sha256(password.encode()).hexdigest()
     if password_hash == ADMIN_PASSWORD_HASH:
-        admin_sessions[user_id] = True
+        admin_sessions.set(user_id, True)
         logger.info(f"✅ Админ {user_id} авторизовался")
         return True
     
@@ -123,127 +724,661 @@ def authenticate_admin(user_id, password):
     return False
 
 def logout_admin(user_id):
-    if user_id in admin_sessions:
-        del admin_sessions[user_id]
+    admin_sessions.delete(user_id)
+
+# ========== КЭШ ПРОФИЛЕЙ ==========
+# Строки users читаются через ограниченный LRU-кэш с TTL. Все пути записи
+# сбрасывают запись; TTL ограничивает устаревание между воркерами gunicorn
+class UserCache:
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id, loader):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            version = self.version
+        
+        value = loader(user_id)
+        
+        with self.lock:
+            # Если за время чтения была запись, результат мог устареть
+            if version == self.version:
+                self.entries[user_id] = (value, now + self.ttl)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+    
+    def invalidate(self, user_id):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(user_id, None)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+user_cache = UserCache()
+
+def load_user(user_id):
+    conn = get_db_connection()
+    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return dict(user) if user else None
+
+def get_user(user_id):
+    ctx = get_update_context(user_id)
+    if ctx:
+        return ctx.user
+    return user_cache.get(user_id, load_user)
+
+def invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+    invalidate_update_context(user_id)
+
+# ========== КОНТЕКСТ ОБНОВЛЕНИЯ ==========
+# На время обработки одного обновления его пользователь, число подписчиков,
+# текущий статус и часовой пояс загружаются лениво и не больше одного раза.
+# Хелперы ниже сначала смотрят в контекст, поэтому обработчики и рендеры
+# берут данные из него без передачи лишних аргументов
+class UpdateContext:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.values = {}
+    
+    def load(self, key, loader):
+        if key not in self.values:
+            self.values[key] = loader(self.user_id)
+        return self.values[key]
+    
+    @property
+    def user(self):
+        return self.load("user", lambda user_id: user_cache.get(user_id, load_user))
+    
+    @property
+    def subscriber_count(self):
+        return self.load("subscriber_count", load_subscriber_count)
+    
+    @property
+    def latest_status(self):
+        return self.load("latest_status", load_current_status)
+    
+    @property
+    def timezone(self):
+        return self.user['timezone'] if self.user else 'Asia/Yekaterinburg'
+    
+    def invalidate(self, key=None):
+        if key:
+            self.values.pop(key, None)
+        else:
+            self.values.clear()
+
+current_update = contextvars.ContextVar("current_update", default=None)
+
+def get_update_context(user_id):
+    ctx = current_update.get()
+    if ctx is not None and ctx.user_id == user_id:
+        return ctx
+    return None
+
+def invalidate_update_context(user_id, key=None):
+    ctx = get_update_context(user_id)
+    if ctx:
+        ctx.invalidate(key)
+
+def get_update_user_id(update):
+    try:
+        if "callback_query" in update:
+            return update["callback_query"]["from"]["id"]
+        if "message" in update:
+            return update["message"]["from"]["id"]
+    except (KeyError, TypeError):
+        pass
+    return None
 
 # ========== ОСНОВНЫЕ ФУНКЦИИ ==========
 def get_user_timezone(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT timezone FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
+    ctx = get_update_context(user_id)
+    if ctx:
+        return ctx.timezone
+    user = get_user(user_id)
     return user['timezone'] if user else 'Asia/Yekaterinburg'
 
 def get_user_server_info(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT server_info FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = get_user(user_id)
     return user['server_info'] if user else 'Сервер'
 
 def get_current_time(user_id=None):
     timezone_str = get_user_timezone(user_id) if user_id else 'Asia/Yekaterinburg'
+    return format_current_time(timezone_str)
+
+# ========== ЧАСОВЫЕ ПОЯСА ==========
+# Объекты поясов создаются один раз на имя, а строка "сейчас" форматируется
+# не чаще раза в секунду на пояс: при рассылке и отрисовке меню она одна и та же
+TIME_FORMAT = "%H:%M:%S %d.%m.%Y"
+timezone_registry = {}
+formatted_time_cache = {}
+
+def get_timezone(timezone_str):
+    tz = timezone_registry.get(timezone_str)
+    if tz is None:
+        # Неизвестный пояс бросает исключение и в реестр не попадает
+        tz = pytz.timezone(timezone_str) if pytz else ZoneInfo(timezone_str)
+        timezone_registry[timezone_str] = tz
+    return tz
+
+def format_current_time(timezone_str):
+    now = time.time()
+    second = int(now)
+    cached = formatted_time_cache.get(timezone_str)
+    if cached and cached[0] == second:
+        return cached[1]
+    
     try:
-        tz = pytz.timezone(timezone_str)
-        return datetime.now(tz).strftime("%H:%M:%S %d.%m.%Y")
-    except:
-        return datetime.now().strftime("%H:%M:%S %d.%m.%Y")
+        text = datetime.fromtimestamp(second, get_timezone(timezone_str)).strftime(TIME_FORMAT)
+    except Exception:
+        text = datetime.fromtimestamp(second).strftime(TIME_FORMAT)
+    formatted_time_cache[timezone_str] = (second, text)
+    return text
+
+# ========== HTTP-КЛИЕНТ ==========
+class HTTPConnectionPool:
+    # Пул keep-alive соединений к одному хосту. Соединение в каждый момент
+    # принадлежит одному потоку; в пуле хранится не больше size простаивающих
+    def __init__(self, scheme, host, port, size=HTTP_POOL_SIZE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, idle_timeout=HTTP_IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = Lock()
+    
+    def _new_connection(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+    
+    def _evict_idle(self, now):
+        # Самые старые соединения лежат в начале списка
+        while self.idle and now - self.idle[0][1] >= self.idle_timeout:
+            conn, _ = self.idle.pop(0)
+            conn.close()
+    
+    def acquire(self):
+        with self.lock:
+            self._evict_idle(time.monotonic())
+            if self.idle:
+                conn, _ = self.idle.pop()
+                return conn, True
+        return self._new_connection(), False
+    
+    def release(self, conn, reusable):
+        if reusable:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((conn, time.monotonic()))
+                    return
+        conn.close()
+    
+    def close(self):
+        with self.lock:
+            for conn, _ in self.idle:
+                conn.close()
+            self.idle = []
+    
+    def request(self, method, path, body=None, headers=None, timeout=HTTP_READ_TIMEOUT):
+        for attempt in range(2):
+            # Повтор идет только на новом соединении: остальные простаивающие
+            # могли быть закрыты сервером так же, как первое
+            conn, reused = self.acquire() if attempt == 0 else (self._new_connection(), False)
+            reusable = False
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.sock.settimeout(timeout)
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+                reusable = not response.will_close
+                return response.status, data
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    ConnectionResetError, BrokenPipeError):
+                # Сервер закрыл простаивавшее соединение - сбрасываем весь пул
+                # и повторяем один раз на новом
+                if reused:
+                    self.close()
+                    continue
+                raise
+            finally:
+                self.release(conn, reusable)
+
+http_pools = {}
+http_pools_lock = Lock()
+
+def get_http_pool(scheme, host, port):
+    key = (scheme, host, port)
+    pool = http_pools.get(key)
+    if pool is None:
+        with http_pools_lock:
+            pool = http_pools.get(key)
+            if pool is None:
+                pool = HTTPConnectionPool(scheme, host, port)
+                http_pools[key] = pool
+    return pool
+
+def api_url(method):
+    return f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}"
+
+# ========== JSON ==========
+# orjson заметно быстрее на кодировании и разборе ответов (в т.ч. пачек
+# getUpdates); без него работает стандартный json с тем же результатом
+if orjson:
+    encode_json = orjson.dumps
+    decode_json = orjson.loads
+else:
+    def encode_json(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    decode_json = json.loads
+
+def encode_payload(payload):
+    # Заранее закодированная клавиатура (bytes) вклеивается в тело без повторной сериализации
+    markup = payload.get("reply_markup")
+    if isinstance(markup, bytes):
+        body = encode_json({key: value for key, value in payload.items() if key != "reply_markup"})
+        return b'%s,"reply_markup":%s}' % (body[:-1], markup)
+    return encode_json(payload)
+
+def with_chat_id(body, chat_id):
+    # Общее тело без chat_id кодируется один раз, получатель дописывается в начало
+    return b'{"chat_id":%d,%s' % (int(chat_id), body[1:])
 
-def safe_request(url, data=None, method="GET", timeout=8):
+def encode_request_body(data, method):
+    # Уже закодированное тело (bytes) отправляется как есть
+    if isinstance(data, bytes):
+        return "POST", data, {'Content-Type': 'application/json'}
+    if data and method == "POST":
+        return "POST", encode_payload(data), {'Content-Type': 'application/json'}
+    return "GET", None, {}
+
+def safe_request(url, data=None, method="GET", timeout=HTTP_READ_TIMEOUT):
+    # В asyncio-режиме синхронные вызовы из потоков обработчиков
+    # выполняются общим асинхронным клиентом в цикле событий
+    if async_loop is not None and threading.get_ident() != async_loop_thread_id:
+        try:
+            future = asyncio.run_coroutine_threadsafe(async_safe_request(url, data, method, timeout), async_loop)
+            return future.result()
+        except Exception as e:
+            logger.error(f"Ошибка запроса: {e}")
+            return None
+    
+    start = time.perf_counter()
+    status = "error"
     try:
-        if data and method == "POST":
-            data_str = json.dumps(data, ensure_ascii=False)
-            data_bytes = data_str.encode('utf-8')
-            req = urllib.request.Request(
-                url, 
-                data=data_bytes,
-                headers={'Content-Type': 'application/json'},
-                method='POST'
-            )
-        else:
-            req = urllib.request.Request(url)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        
+        method, body, headers = encode_request_body(data, method)
+        
+        pool = get_http_pool(parts.scheme, parts.hostname, parts.port)
+        status, raw = pool.request(method, path, body, headers, timeout)
+        result = decode_json(raw)
         
-        response = urllib.request.urlopen(req, timeout=timeout)
-        result = json.loads(response.read().decode())
+        # Тело ошибки возвращается вызывающему: в нем error_code и retry_after
+        if status >= 400:
+            logger.error(f"Ошибка запроса: HTTP {status}: {result.get('description')}")
         return result
         
     except Exception as e:
         logger.error(f"Ошибка запроса: {e}")
         return None
+    finally:
+        observe_api_request(url, status, time.perf_counter() - start)
 
-def send_message(chat_id, text, buttons=None, parse_mode="HTML", thread_id=None):
+# ========== ПЛАНИРОВЩИК ИСХОДЯЩИХ СООБЩЕНИЙ ==========
+# Все sendMessage/editMessageText проходят через общий планировщик, который
+# соблюдает лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат,
+# 20/мин в группу. Интерактивные ответы обгоняют массовые рассылки,
+# а ответы 429 откладывают чат на retry_after без потери сообщения
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+    
+    def delay(self, now):
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self):
+        self.tokens -= 1
+    
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+    
+    def is_idle(self, now):
+        return now >= self.blocked_until and self.delay(now) == 0 and self.tokens >= self.burst
+
+class OutboundJob:
+    def __init__(self, method, payload, chat_id, priority):
+        self.method = method
+        self.payload = payload
+        self.chat_id = chat_id
+        self.priority = priority
+        self.attempts = 0
+        self.future = Future()
+
+class OutboundScheduler:
+    def __init__(self, workers=OUTBOUND_WORKERS, global_rate=OUTBOUND_GLOBAL_RATE):
+        self.workers = workers
+        self.cond = threading.Condition()
+        # Без запаса на всплеск: в любом окне в 1 с уходит не больше global_rate сообщений
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_buckets = {}
+        # Очереди каждого чата по приоритетам и кучи готовых чатов (ready_at, seq, chat_id)
+        self.chat_queues = {}
+        self.ready = ([], [])
+        self.scheduled = set()
+        self.seq = itertools.count()
+        self.pending = 0
+        self.executor = None
+        self.last_prune = time.monotonic()
+    
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                # Запас сверх одного сообщения вычитается из пополнения: за любую
+                # минуту в группу уходит не больше OUTBOUND_GROUP_PER_MINUTE
+                bucket = TokenBucket(
+                    max(1, OUTBOUND_GROUP_PER_MINUTE - (OUTBOUND_GROUP_BURST - 1)) / 60, OUTBOUND_GROUP_BURST)
+            else:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def start(self):
+        with self.cond:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbound")
+            Thread(target=self.run, name="outbound-scheduler", daemon=True).start()
+        logger.info(f"📤 Планировщик исходящих сообщений запущен, воркеров: {self.workers}")
+    
+    def submit(self, method, payload, chat_id, priority=PRIORITY_INTERACTIVE):
+        self.start()
+        job = OutboundJob(method, payload, chat_id, priority)
+        with self.cond:
+            self.enqueue(job, time.monotonic())
+            self.pending += 1
+            self.cond.notify()
+        return job.future
+    
+    def enqueue(self, job, ready_at, front=False):
+        queues = self.chat_queues.setdefault(job.chat_id, (deque(), deque()))
+        if front:
+            queues[job.priority].appendleft(job)
+        else:
+            queues[job.priority].append(job)
+        if (job.priority, job.chat_id) not in self.scheduled:
+            self.scheduled.add((job.priority, job.chat_id))
+            heapq.heappush(self.ready[job.priority], (ready_at, next(self.seq), job.chat_id))
+    
+    def next_job(self, now):
+        wait = self.global_bucket.delay(now)
+        if wait > 0:
+            return None, wait
+        
+        wait = None
+        for priority, heap in enumerate(self.ready):
+            while heap and heap[0][0] <= now:
+                _, _, chat_id = heapq.heappop(heap)
+                bucket = self.chat_bucket(chat_id)
+                delay = bucket.delay(now)
+                if delay > 0:
+                    heapq.heappush(heap, (now + delay, next(self.seq), chat_id))
+                    continue
+                
+                queues = self.chat_queues[chat_id]
+                job = queues[priority].popleft()
+                bucket.consume()
+                self.global_bucket.consume()
+                if queues[priority]:
+                    heapq.heappush(heap, (now, next(self.seq), chat_id))
+                else:
+                    self.scheduled.discard((priority, chat_id))
+                    if not queues[0] and not queues[1]:
+                        del self.chat_queues[chat_id]
+                return job, 0
+            if heap:
+                wait = heap[0][0] - now if wait is None else min(wait, heap[0][0] - now)
+        return None, wait
+    
+    def prune_buckets(self, now):
+        # Полные и давно не используемые бакеты можно забыть без потери точности
+        self.last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if chat_id not in self.chat_queues and bucket.is_idle(now)]:
+            del self.chat_buckets[chat_id]
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if now - self.last_prune > 60:
+                        self.prune_buckets(now)
+                    job, wait = self.next_job(now)
+                    if job:
+                        break
+                    self.cond.wait(wait)
+            self.dispatch(job)
+    
+    def dispatch(self, job):
+        job.attempts += 1
+        if async_loop is not None:
+            future = asyncio.run_coroutine_threadsafe(
+                async_safe_request(api_url(job.method), job.payload, "POST"), async_loop)
+        else:
+            future = self.executor.submit(safe_request, api_url(job.method), job.payload, "POST")
+        future.add_done_callback(lambda done: self.complete(job, done))
+    
+    def complete(self, job, done):
+        try:
+            result = done.result()
+        except Exception as e:
+            logger.error(f"Ошибка отправки {job.method}: {e}")
+            result = None
+        
+        now = time.monotonic()
+        if result is not None and result.get('error_code') == 429:
+            # Ожидание по 429 не считается попыткой: сообщение не должно потеряться
+            retry_after = result.get('parameters', {}).get('retry_after', 1)
+            job.attempts -= 1
+            logger.warning(f"⏳ Лимит Telegram для чата {job.chat_id}, повтор через {retry_after} с")
+            self.retry(job, now + retry_after)
+        elif (result is None or result.get('error_code', 0) >= 500) and job.attempts < OUTBOUND_MAX_ATTEMPTS:
+            # Сетевая ошибка или 5xx на стороне Telegram - повтор с экспоненциальной паузой
+            self.retry(job, now + min(2 ** job.attempts, 30))
+        else:
+            with self.cond:
+                self.pending -= 1
+            job.future.set_result(result)
+    
+    def retry(self, job, ready_at):
+        with self.cond:
+            self.chat_bucket(job.chat_id).block(ready_at)
+            self.enqueue(job, ready_at, front=True)
+            self.cond.notify()
+
+outbound_scheduler = OutboundScheduler()
+
+def schedule_request(method, payload, priority=PRIORITY_INTERACTIVE, chat_id=None):
+    if chat_id is None:
+        chat_id = payload["chat_id"]
+    return outbound_scheduler.submit(method, payload, chat_id, priority)
+
+def wait_outbound(future):
+    try:
+        return future.result(timeout=OUTBOUND_WAIT_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Ошибка ожидания отправки: {e}")
+        return None
+
+def build_message_payload(chat_id, text, buttons=None, parse_mode="HTML", thread_id=None, message_id=None):
     payload = {
         "chat_id": chat_id,
         "text": text,
         "parse_mode": parse_mode
     }
     
+    if message_id:
+        payload["message_id"] = message_id
+    
     if thread_id:
         payload["message_thread_id"] = thread_id
     
     if buttons:
-        payload["reply_markup"] = {"inline_keyboard": buttons}
+        if isinstance(buttons, StaticKeyboard):
+            payload["reply_markup"] = buttons.markup
+        else:
+            payload["reply_markup"] = {"inline_keyboard": buttons}
     
-    result = safe_request(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-        payload,
-        "POST"
+    return payload
+
+def schedule_message(chat_id, text, buttons=None, parse_mode="HTML", thread_id=None, priority=PRIORITY_BULK):
+    return schedule_request(
+        "sendMessage",
+        build_message_payload(chat_id, text, buttons, parse_mode, thread_id=thread_id),
+        priority
     )
-    return result
+
+def schedule_encoded_message(chat_id, body, priority=PRIORITY_BULK):
+    # body - общее для всех получателей тело sendMessage без chat_id
+    return schedule_request("sendMessage", with_chat_id(body, chat_id), priority, chat_id)
+
+def send_message(chat_id, text, buttons=None, parse_mode="HTML", thread_id=None):
+    return wait_outbound(schedule_message(chat_id, text, buttons, parse_mode, thread_id, PRIORITY_INTERACTIVE))
 
 def edit_message(chat_id, message_id, text, buttons=None, parse_mode="HTML"):
-    payload = {
-        "chat_id": chat_id,
-        "message_id": message_id,
-        "text": text,
-        "parse_mode": parse_mode
-    }
-    
-    if buttons:
-        payload["reply_markup"] = {"inline_keyboard": buttons}
-    
-    result = safe_request(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/editMessageText",
-        payload,
-        "POST"
-    )
+    result = wait_outbound(schedule_request(
+        "editMessageText",
+        build_message_payload(chat_id, text, buttons, parse_mode, message_id=message_id)
+    ))
     return result and result.get('ok')
 
-def answer_callback(callback_id):
-    safe_request(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery",
-        {"callback_query_id": callback_id},
-        "POST"
-    )
+# Ответ на нажатие кнопки только гасит "часики" у пользователя, поэтому
+# обработчик его не ждет: запрос уходит в фоне, а в режиме webhook
+# возвращается прямо в теле ответа на вебхук, без отдельного запроса
+callback_ack_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="callback-ack")
+
+def build_callback_answer(callback_id, text=None):
+    payload = {"callback_query_id": callback_id}
+    if text:
+        payload["text"] = text
+    return payload
+
+def answer_callback(callback_id, text=None):
+    payload = build_callback_answer(callback_id, text)
+    if async_loop is not None:
+        asyncio.run_coroutine_threadsafe(
+            async_safe_request(api_url("answerCallbackQuery"), payload, "POST"), async_loop)
+    else:
+        callback_ack_executor.submit(safe_request, api_url("answerCallbackQuery"), payload, "POST")
+
+def get_webhook_callback_ack(update):
+    callback = update.get("callback_query")
+    if not isinstance(callback, dict) or "id" not in callback:
+        return None
+    payload = build_callback_answer(callback["id"], CALLBACK_TOASTS.get(callback.get("data")))
+    payload["method"] = "answerCallbackQuery"
+    # Отметка для process_callback: повторно отвечать на нажатие не нужно
+    callback["answered_inline"] = True
+    return encode_json(payload)
 
 # ========== РАБОТА С ПОЛЬЗОВАТЕЛЯМИ ==========
 def setup_user_settings(user_id, group_id, thread_id, message_id, group_name, server_info="Сервер"):
-    conn = get_db_connection()
-    conn.execute('''
+    db_writer.execute('''
         INSERT OR REPLACE INTO users (user_id, group_id, thread_id, message_id, group_name, server_info)
         VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, group_id, thread_id, message_id, group_name, server_info))
-    conn.commit()
-    conn.close()
+    ''', (user_id, group_id, thread_id, message_id, group_name, server_info)).result()
+    invalidate_user(user_id)
 
-def reset_user_settings(user_id):
-    conn = get_db_connection()
+def change_status_counter(conn, status, delta):
+    conn.execute('''
+        INSERT INTO status_counters (status, count) VALUES (?, ?)
+        ON CONFLICT (status) DO UPDATE SET count = count + excluded.count
+    ''', (status, delta))
+
+def change_subscriber_count(conn, target_user_id, delta):
+    conn.execute('''
+        INSERT INTO subscriber_counts (target_user_id, count) VALUES (?, ?)
+        ON CONFLICT (target_user_id) DO UPDATE SET count = count + excluded.count
+    ''', (target_user_id, delta))
+
+def delete_user_data(conn, user_id):
     conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM server_statuses WHERE user_id = ?', (user_id,))
+    
+    current = conn.execute('SELECT status FROM current_status WHERE user_id = ?', (user_id,)).fetchone()
+    if current:
+        change_status_counter(conn, current['status'], -1)
+        conn.execute('DELETE FROM current_status WHERE user_id = ?', (user_id,))
+    
+    conn.execute('''
+        UPDATE subscriber_counts SET count = count - 1
+        WHERE target_user_id IN (SELECT target_user_id FROM subscriptions WHERE subscriber_id = ? AND target_user_id != ?)
+    ''', (user_id, user_id))
+    conn.execute('DELETE FROM subscriber_counts WHERE target_user_id = ?', (user_id,))
     conn.execute('DELETE FROM subscriptions WHERE subscriber_id = ? OR target_user_id = ?', (user_id, user_id))
-    conn.commit()
-    conn.close()
+    log_subscription_change(conn, "remove_user", user_id)
+    conn.execute('DELETE FROM status_rollups WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM status_rollup_carry WHERE user_id = ?', (user_id,))
+
+def reset_user_settings(user_id):
+    db_writer.call(delete_user_data, user_id).result()
+    subscription_index.apply("remove_user", user_id)
+    invalidate_user(user_id)
     
-    if user_id in user_states:
-        del user_states[user_id]
+    user_states.delete(user_id)
     
     logout_admin(user_id)
     logger.info(f"🔄 Настройки пользователя {user_id} сброшены")
 
 def send_new_status_message(user_id, status_text):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    user = get_user(user_id)
     
     if not user:
-        conn.close()
         return False
     
     result = send_message(
@@ -254,13 +1389,11 @@ def send_new_status_message(user_id, status_text):
     
     if result and result.get('ok'):
         new_message_id = result["result"]["message_id"]
-        conn.execute('UPDATE users SET message_id = ? WHERE user_id = ?', (new_message_id, user_id))
-        conn.commit()
-        conn.close()
+        db_writer.execute('UPDATE users SET message_id = ? WHERE user_id = ?', (new_message_id, user_id)).result()
+        invalidate_user(user_id)
         logger.info(f"✅ Создано новое сообщение: {new_message_id}")
         return True
     
-    conn.close()
     return False
 
 def create_and_setup_message(user_id, group_id, group_name=None):
@@ -292,200 +1425,1018 @@ def create_and_setup_message(user_id, group_id, group_name=None):
         error_msg = f"Ошибка: {str(e)}"
         return False, error_msg
 
+# Правки сообщения статуса в группе копятся STATUS_EDIT_WINDOW секунд с первого
+# нажатия, и в Telegram уходит только последний статус. Так частые нажатия
+# не съедают лимит 20 правок/мин группы. Текст, совпадающий с уже
+# отправленным (без учета времени), не отправляется вовсе, а подписчики
+# получают уведомление, только если статус за окно действительно сменился.
+# Правки одного сообщения не пересекаются: новая ждет ответа на предыдущую
+class StatusEditCoalescer:
+    def __init__(self, window=STATUS_EDIT_WINDOW):
+        self.window = window
+        self.cond = threading.Condition()
+        # (group_id, message_id) -> [user_id, статус, статус до начала окна]
+        self.pending = {}
+        self.due = []
+        # (group_id, message_id) -> содержимое последней успешной правки
+        self.pushed = {}
+        # (group_id, message_id) -> содержимое правки, ждущей ответа Telegram
+        self.inflight = {}
+        # Правки, отложенные до ответа на текущую, в формате pending
+        self.waiting = {}
+        self.started = False
+    
+    def submit(self, key, user_id, status, previous_status):
+        with self.cond:
+            entry = self.pending.get(key)
+            if entry:
+                entry[0] = user_id
+                entry[1] = status
+                return
+            self.pending[key] = [user_id, status, previous_status]
+            heapq.heappush(self.due, (time.monotonic() + self.window, key))
+            if not self.started:
+                self.started = True
+                Thread(target=self.run, name="status-edits", daemon=True).start()
+            self.cond.notify()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    self.cond.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                _, key = heapq.heappop(self.due)
+                user_id, status, previous_status = self.pending.pop(key)
+            try:
+                self.flush(key, user_id, status, previous_status)
+            except Exception as e:
+                logger.error(f"Ошибка обновления сообщения статуса: {e}")
+    
+    def flush(self, key, user_id, status, previous_status):
+        fields = status_message_fields(user_id, status)
+        content = tuple(fields.values())
+        with self.cond:
+            if key in self.inflight:
+                entry = self.waiting.setdefault(key, [user_id, status, previous_status])
+                entry[0] = user_id
+                entry[1] = status
+                return
+            if self.pushed.get(key) == content:
+                logger.info(f"⏭️ Сообщение {key[1]} не изменилось, правка пропущена")
+                return
+            self.inflight[key] = content
+        
+        try:
+            text = render_status_message(time=get_current_time(user_id), **fields)
+            future = schedule_request("editMessageText", build_message_payload(key[0], text, message_id=key[1]))
+        except Exception:
+            self.release(key, None)
+            raise
+        future.add_done_callback(
+            lambda done: self.complete(key, user_id, status, previous_status, content, done.result()))
+    
+    def release(self, key, content):
+        # Снимает отметку отправки и ставит в очередь отложенную правку
+        with self.cond:
+            del self.inflight[key]
+            if content is not None:
+                self.pushed[key] = content
+            waiting = self.waiting.pop(key, None)
+            if not waiting:
+                return
+            entry = self.pending.get(key)
+            if entry:
+                entry[2] = waiting[2]
+            else:
+                self.pending[key] = waiting
+                heapq.heappush(self.due, (time.monotonic(), key))
+                self.cond.notify()
+    
+    def complete(self, key, user_id, status, previous_status, content, result):
+        if result and (result.get('ok') or 'message is not modified' in result.get('description', '')):
+            self.release(key, content)
+            logger.info(f"✅ Сообщение {key[1]} отредактировано")
+            if status != previous_status:
+                notify_subscribers(user_id, status)
+        else:
+            # В группе осталась прежняя правка: pushed не меняется
+            self.release(key, None)
+            logger.warning(f"❌ Не удалось отредактировать сообщение")
+            description = (result or {}).get('description', '').lower()
+            if 'message not found' in description or 'message to edit not found' in description:
+                # Сообщение в группе удалено - владелец должен создать новое
+                schedule_message(user_id,
+                                 "❌ <b>Сообщение не найдено!</b>\n\n"
+                                 "Бот не может найти сообщение для редактирования.\n"
+                                 "Возможно, сообщение было удалено или не настроено.\n\n"
+                                 "Создайте новое сообщение для статуса:",
+                                 get_create_message_buttons(), priority=PRIORITY_INTERACTIVE)
+
+status_edit_coalescer = StatusEditCoalescer()
+
+def record_status_change(conn, user_id, status):
+    # Выполняется одним шагом писателя: строка истории, текущий статус и
+    # счетчики попадают в одну транзакцию, а старый статус читается
+    # под блокировкой записи и счетчики не разъезжаются при гонках
+    conn.execute('INSERT INTO server_statuses (user_id, status) VALUES (?, ?)', (user_id, status))
+    previous = conn.execute('SELECT status FROM current_status WHERE user_id = ?', (user_id,)).fetchone()
+    conn.execute('''
+        INSERT INTO current_status (user_id, status, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+    ''', (user_id, status))
+    previous_status = previous['status'] if previous else None
+    if previous:
+        change_status_counter(conn, previous_status, -1)
+    change_status_counter(conn, status, 1)
+    return previous_status
+
 def update_server_status(user_id, status):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    user = get_user(user_id)
     
     if not user:
-        conn.close()
         return False
     
-    conn.execute('INSERT INTO server_statuses (user_id, status) VALUES (?, ?)', (user_id, status))
-    conn.commit()
-    conn.close()
-    
-    status_text = generate_status_text(user_id, status)
+    previous_status = db_writer.call(record_status_change, user_id, status).result()
+    invalidate_update_context(user_id, "latest_status")
     
     if user['message_id']:
-        success = edit_message(user['group_id'], user['message_id'], status_text)
-        if success:
-            logger.info(f"✅ Сообщение {user['message_id']} отредактировано")
-            notify_subscribers(user_id, status)
-        else:
-            logger.warning(f"❌ Не удалось отредактировать сообщение")
-        return success
+        # История уже записана, правка в группе уйдет после окна склейки
+        status_edit_coalescer.submit((user['group_id'], user['message_id']), user_id, status, previous_status)
+        return True
     else:
         logger.warning("❌ Сообщение для редактирования не найдено")
         return False
 
-def generate_status_text(user_id, status):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    subscriber_count = get_subscriber_count(user_id)
-    conn.close()
-    
-    status_emojis = {
-        "status_on": "🟢",
-        "status_pause": "🟡", 
-        "status_off": "🔴",
-        "status_unknown": "❓"
-    }
-    
-    status_names = {
-        "status_on": "ВКЛЮЧЕН",
-        "status_pause": "ПРИОСТАНОВЛЕН",
-        "status_off": "ВЫКЛЮЧЕН", 
-        "status_unknown": "НЕИЗВЕСТНО"
+def status_message_fields(user_id, status):
+    user = get_user(user_id)
+    
+    return {
+        "emoji": STATUS_EMOJIS.get(status, "❓"),
+        "name": STATUS_NAMES.get(status, "НЕИЗВЕСТНО"),
+        "server_info": user['server_info'] if user else 'Сервер',
+        "owner": user['group_name'] if user else 'Неизвестно',
+        "subscriber_count": get_subscriber_count(user_id)
     }
-    
-    emoji = status_emojis.get(status, "❓")
-    name = status_names.get(status, "НЕИЗВЕСТНО")
-    server_info = get_user_server_info(user_id)
-    
-    return f"""{emoji} <b>Статус {server_info}</b>
 
-📊 Статус: <b>{name}</b>
-👤 Владелец: {user['group_name'] if user else 'Неизвестно'}
-👥 Подписчиков: {subscriber_count}
-⏰ Обновлено: {get_current_time(user_id)}
+def generate_status_text(user_id, status):
+    return render_status_message(time=get_current_time(user_id), **status_message_fields(user_id, status))
 
-💡 Используйте бота для управления статусом"""
+def load_subscriber_count(target_user_id):
+    count = subscription_index.subscriber_count(target_user_id)
+    if count is not None:
+        return count
+    conn = get_db_connection()
+    count = conn.execute('SELECT count FROM subscriber_counts WHERE target_user_id = ?', (target_user_id,)).fetchone()
+    return count['count'] if count else 0
 
 def get_subscriber_count(target_user_id):
+    ctx = get_update_context(target_user_id)
+    if ctx:
+        return ctx.subscriber_count
+    return load_subscriber_count(target_user_id)
+
+def load_current_status(user_id):
     conn = get_db_connection()
-    count = conn.execute('SELECT COUNT(*) as count FROM subscriptions WHERE target_user_id = ?', (target_user_id,)).fetchone()
-    conn.close()
-    return count['count'] if count else 0
+    current = conn.execute('SELECT status FROM current_status WHERE user_id = ?', (user_id,)).fetchone()
+    return current['status'] if current else None
+
+def get_current_status(user_id):
+    ctx = get_update_context(user_id)
+    if ctx:
+        return ctx.latest_status
+    return load_current_status(user_id)
+
+# Рассылка уведомлений подписчикам идет фоновой задачей: кнопка владельца
+# не ждет последнего подписчика, а прогресс виден в управлении статусом
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+fanout_progress = {}
+
+def classify_send_result(result):
+    if result and result.get('ok'):
+        return "sent"
+    if result and result.get('error_code') == 403:
+        return "blocked"
+    return "failed"
 
 def notify_subscribers(user_id, new_status):
-    conn = get_db_connection()
-    server_info = conn.execute('SELECT group_name, server_info FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    if not server_info:
-        conn.close()
-        return
-    
-    subscribers = conn.execute('SELECT subscriber_id FROM subscriptions WHERE target_user_id = ?', (user_id,)).fetchall()
-    conn.close()
-    
-    if not subscribers:
-        return
-    
-    status_names = {
-        "status_on": "🟢 ВКЛЮЧЕН",
-        "status_pause": "🟡 ПРИОСТАНОВЛЕН",
-        "status_off": "🔴 ВЫКЛЮЧЕН",
-        "status_unknown": "❓ НЕИЗВЕСТНО"
+    progress = {
+        "status": new_status,
+        "total": 0,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "done": False,
+        "started_at": time.time()
     }
-    
-    notification_text = (
-        f"🔔 <b>Изменение статуса {server_info['server_info']}</b>\n\n"
-        f"Владелец: <b>{server_info['group_name']}</b>\n"
-        f"Новый статус: {status_names.get(new_status, 'Неизвестно')}\n"
-        f"⏰ Время: {get_current_time()}"
-    )
-    
-    for sub in subscribers:
-        try:
-            send_message(sub['subscriber_id'], notification_text)
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления: {e}")
+    fanout_progress[user_id] = progress
+    fanout_executor.submit(run_fanout, user_id, new_status, progress)
+    return progress
 
-# ========== ПОДПИСКИ ==========
-def subscribe_to_server(subscriber_id, target_user_id):
-    conn = get_db_connection()
-    
-    existing = conn.execute('''
-        SELECT * FROM subscriptions 
-        WHERE subscriber_id = ? AND target_user_id = ?
-    ''', (subscriber_id, target_user_id)).fetchone()
-    
-    if not existing:
-        conn.execute('''
-            INSERT INTO subscriptions (subscriber_id, target_user_id) 
-            VALUES (?, ?)
-        ''', (subscriber_id, target_user_id))
-        conn.commit()
+def run_fanout(user_id, new_status, progress):
+    try:
+        server_info = get_user(user_id)
+        if not server_info:
+            return
         
-        server_owner = conn.execute('SELECT group_name, server_info FROM users WHERE user_id = ?', (target_user_id,)).fetchone()
-        conn.close()
+        subscribers = subscription_index.subscribers(user_id)
+        if subscribers is None:
+            conn = get_db_connection()
+            subscribers = [row['subscriber_id'] for row in conn.execute(
+                'SELECT subscriber_id FROM subscriptions WHERE target_user_id = ?', (user_id,))]
         
-        if server_owner:
-            send_message(target_user_id, 
-                        f"🔔 <b>Новый подписчик!</b>\n\n"
-                        f"На ваш {server_owner['server_info']} '{server_owner['group_name']}' подписался новый пользователь.")
-        return True
-    else:
-        conn.close()
+        if not subscribers:
+            return
+        
+        # Текст и JSON уведомления готовятся один раз на всех подписчиков
+        body = encode_payload({
+            "text": render_status_notification(
+                server_info=server_info['server_info'],
+                owner=server_info['group_name'],
+                label=STATUS_LABELS.get(new_status, 'Неизвестно'),
+                time=get_current_time()
+            ),
+            "parse_mode": "HTML"
+        })
+        
+        progress["total"] = len(subscribers)
+        # Все сообщения сразу ставятся в планировщик и уходят параллельно
+        # на максимально допустимой скорости
+        futures = [schedule_encoded_message(subscriber_id, body) for subscriber_id in subscribers]
+        for future in futures:
+            # Зависшая отправка не держит рассылку: по таймауту она считается неудачной
+            progress[classify_send_result(wait_outbound(future))] += 1
+        
+        logger.info(f"🔔 Уведомления по {user_id}: ✅ {progress['sent']}, 🚫 {progress['blocked']}, ❌ {progress['failed']}")
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомлений: {e}")
+    finally:
+        progress["done"] = True
+
+def format_fanout_progress(progress):
+    if not progress or not progress["total"]:
+        return ""
+    state = "завершено" if progress["done"] else "идет отправка"
+    return (
+        f"🔔 Уведомления ({state}): ✅ {progress['sent']} · 🚫 {progress['blocked']} · "
+        f"❌ {progress['failed']} из {progress['total']}\n"
+    )
+
+# ========== ПОДПИСКИ ==========
+# Граф подписок в памяти процесса: target -> отсортированный array('q')
+# подписчиков и subscriber -> цели в виде двух плоских отсортированных
+# array('q') без объекта на каждого подписчика (миллион связей - ~25 МБ).
+# Источник истины - таблица subscriptions: индекс грузится из нее фоном и
+# поддерживается при подписке, отписке и сбросе. Изменения из других
+# воркеров подтягиваются по журналу subscription_changes раз в
+# SUBSCRIPTION_INDEX_REFRESH секунд; пока индекс не загружен, чтение идет в базу
+def sorted_insert(index, key, value):
+    values = index.get(key)
+    if values is None:
+        index[key] = array('q', (value,))
+        return
+    i = bisect.bisect_left(values, value)
+    if i == len(values) or values[i] != value:
+        values.insert(i, value)
+
+def sorted_remove(index, key, value):
+    values = index.get(key)
+    if not values:
+        return
+    i = bisect.bisect_left(values, value)
+    if i < len(values) and values[i] == value:
+        del values[i]
+        if not values:
+            del index[key]
+
+class SortedPairs:
+    # Пары (key, value), упорядоченные по key, затем по value
+    def __init__(self):
+        self.keys = array('q')
+        self.values = array('q')
+    
+    def append(self, key, value):
+        self.keys.append(key)
+        self.values.append(value)
+    
+    def find(self, key):
+        lo = bisect.bisect_left(self.keys, key)
+        return lo, bisect.bisect_right(self.keys, key, lo)
+    
+    def add(self, key, value):
+        lo, hi = self.find(key)
+        i = bisect.bisect_left(self.values, value, lo, hi)
+        if i == hi or self.values[i] != value:
+            self.keys.insert(i, key)
+            self.values.insert(i, value)
+    
+    def remove(self, key, value):
+        lo, hi = self.find(key)
+        i = bisect.bisect_left(self.values, value, lo, hi)
+        if i < hi and self.values[i] == value:
+            del self.keys[i]
+            del self.values[i]
+    
+    def pop(self, key):
+        lo, hi = self.find(key)
+        values = self.values[lo:hi]
+        del self.keys[lo:hi]
+        del self.values[lo:hi]
+        return values
+
+class SubscriptionIndex:
+    def __init__(self, refresh=SUBSCRIPTION_INDEX_REFRESH):
+        self.refresh = refresh
+        self.by_target = {}
+        self.by_subscriber = SortedPairs()
+        self.lock = Lock()
+        self.ready = False
+        self.loading = False
+        self.loaded_at = 0
+        self.change_id = 0
+        # Изменения, сделанные во время загрузки, повторяются поверх нее
+        self.journal = None
+    
+    @staticmethod
+    def build(rows):
+        # rows отсортированы по ключу, значения внутри ключа - по возрастанию
+        index = {}
+        current_key = None
+        values = None
+        for key, value in rows:
+            if key != current_key:
+                current_key = key
+                values = index[key] = array('q')
+            values.append(value)
+        return index
+    
+    def start_loading(self):
+        with self.lock:
+            if self.loading:
+                return False
+            self.loading = True
+            self.journal = []
+            return True
+    
+    def load(self):
+        if self.start_loading():
+            self.refresh_index(full=True)
+    
+    def ensure_fresh(self):
+        if self.loading or (self.ready and (not self.refresh or time.monotonic() - self.loaded_at < self.refresh)):
+            return
+        if self.start_loading():
+            Thread(target=self.refresh_index, name="subscription-index", daemon=True).start()
+    
+    def refresh_index(self, full=False):
+        try:
+            if full or not self.ready or not self.catch_up():
+                self.reload()
+        except Exception as e:
+            rollback_db_connection()
+            logger.error(f"❌ Ошибка загрузки индекса подписок: {e}")
+        finally:
+            with self.lock:
+                self.loading = False
+                self.journal = None
+    
+    def finish(self, changes):
+        # Под self.lock: журнал базы, затем свои изменения, сделанные за время чтения
+        for op, *args in changes:
+            getattr(self, f"apply_{op}")(*args)
+        for op, args in self.journal:
+            getattr(self, f"apply_{op}")(*args)
+        self.loaded_at = time.monotonic()
+    
+    def reload(self):
+        start = time.monotonic()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        # Выборки и позиция журнала читают один снимок WAL
+        cursor.execute('BEGIN')
+        change_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM subscription_changes').fetchone()[0]
+        by_target = self.build(cursor.execute(
+            'SELECT target_user_id, subscriber_id FROM subscriptions ORDER BY target_user_id, subscriber_id'))
+        by_subscriber = SortedPairs()
+        for subscriber_id, target_user_id in cursor.execute(
+                'SELECT subscriber_id, target_user_id FROM subscriptions ORDER BY subscriber_id, target_user_id'):
+            by_subscriber.append(subscriber_id, target_user_id)
+        conn.rollback()
+        
+        with self.lock:
+            self.by_target = by_target
+            self.by_subscriber = by_subscriber
+            self.change_id = change_id
+            self.finish(())
+            self.ready = True
+        edges = sum(len(values) for values in by_target.values())
+        logger.info(f"🔗 Индекс подписок загружен: {edges} связей за {time.monotonic() - start:.2f} с")
+    
+    def catch_up(self):
+        rows = get_db_connection().execute(
+            'SELECT id, op, first_id, second_id FROM subscription_changes WHERE id > ? ORDER BY id',
+            (self.change_id,)
+        ).fetchall()
+        if rows and rows[0]['id'] != self.change_id + 1:
+            # Нужная часть журнала уже удалена
+            return False
+        changes = [(op, first_id) if second_id is None else (op, first_id, second_id)
+                   for _, op, first_id, second_id in rows]
+        with self.lock:
+            if rows:
+                self.change_id = rows[-1]['id']
+            self.finish(changes)
+        return True
+    
+    def subscriber_count(self, target_user_id):
+        self.ensure_fresh()
+        if not self.ready:
+            return None
+        values = self.by_target.get(target_user_id)
+        return len(values) if values else 0
+    
+    def subscribers(self, target_user_id):
+        self.ensure_fresh()
+        if not self.ready:
+            return None
+        with self.lock:
+            return self.by_target.get(target_user_id, array('q')).tolist()
+    
+    def apply(self, op, *args):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append((op, args))
+            getattr(self, f"apply_{op}")(*args)
+    
+    def apply_add(self, subscriber_id, target_user_id):
+        sorted_insert(self.by_target, target_user_id, subscriber_id)
+        self.by_subscriber.add(subscriber_id, target_user_id)
+    
+    def apply_remove(self, subscriber_id, target_user_id):
+        sorted_remove(self.by_target, target_user_id, subscriber_id)
+        self.by_subscriber.remove(subscriber_id, target_user_id)
+    
+    def apply_remove_subscriber(self, subscriber_id):
+        for target_user_id in self.by_subscriber.pop(subscriber_id):
+            sorted_remove(self.by_target, target_user_id, subscriber_id)
+    
+    def apply_remove_user(self, user_id):
+        self.apply_remove_subscriber(user_id)
+        for subscriber_id in self.by_target.pop(user_id, ()):
+            self.by_subscriber.remove(subscriber_id, user_id)
+
+subscription_index = SubscriptionIndex()
+
+def log_subscription_change(conn, op, first_id, second_id=None):
+    conn.execute(
+        'INSERT INTO subscription_changes (op, first_id, second_id, created_at) VALUES (?, ?, ?, ?)',
+        (op, first_id, second_id, time.time())
+    )
+
+def insert_subscription(conn, subscriber_id, target_user_id):
+    inserted = conn.execute('''
+        INSERT INTO subscriptions (subscriber_id, target_user_id) 
+        VALUES (?, ?)
+        ON CONFLICT (subscriber_id, target_user_id) DO NOTHING
+    ''', (subscriber_id, target_user_id)).rowcount
+    if inserted:
+        change_subscriber_count(conn, target_user_id, 1)
+        log_subscription_change(conn, "add", subscriber_id, target_user_id)
+    return inserted
+
+def subscribe_to_server(subscriber_id, target_user_id):
+    inserted = db_writer.call(insert_subscription, subscriber_id, target_user_id).result()
+    if inserted:
+        subscription_index.apply("add", subscriber_id, target_user_id)
+    invalidate_update_context(target_user_id, "subscriber_count")
+    
+    if not inserted:
         return False
+    
+    server_owner = get_user(target_user_id)
+    
+    if server_owner:
+        send_message(target_user_id, 
+                    f"🔔 <b>Новый подписчик!</b>\n\n"
+                    f"На ваш {server_owner['server_info']} '{server_owner['group_name']}' подписался новый пользователь.")
+    return True
 
-def unsubscribe_from_all(subscriber_id):
-    conn = get_db_connection()
+def delete_all_subscriptions(conn, subscriber_id):
+    conn.execute('''
+        UPDATE subscriber_counts SET count = count - 1
+        WHERE target_user_id IN (SELECT target_user_id FROM subscriptions WHERE subscriber_id = ?)
+    ''', (subscriber_id,))
     conn.execute('DELETE FROM subscriptions WHERE subscriber_id = ?', (subscriber_id,))
-    conn.commit()
-    conn.close()
+    log_subscription_change(conn, "remove_subscriber", subscriber_id)
+
+def unsubscribe_from_all(subscriber_id):
+    db_writer.call(delete_all_subscriptions, subscriber_id).result()
+    subscription_index.apply("remove_subscriber", subscriber_id)
+    invalidate_update_context(subscriber_id, "subscriber_count")
     return True
 
+def delete_subscription(conn, subscriber_id, target_user_id):
+    deleted = conn.execute(
+        'DELETE FROM subscriptions WHERE subscriber_id = ? AND target_user_id = ?',
+        (subscriber_id, target_user_id)
+    ).rowcount
+    if deleted:
+        change_subscriber_count(conn, target_user_id, -1)
+        log_subscription_change(conn, "remove", subscriber_id, target_user_id)
+    return deleted
+
 def unsubscribe_from_server(subscriber_id, target_user_id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM subscriptions WHERE subscriber_id = ? AND target_user_id = ?', (subscriber_id, target_user_id))
-    conn.commit()
-    conn.close()
+    deleted = db_writer.call(delete_subscription, subscriber_id, target_user_id).result()
+    if deleted:
+        subscription_index.apply("remove", subscriber_id, target_user_id)
+    invalidate_update_context(target_user_id, "subscriber_count")
     return True
 
+# ========== ХРАНЕНИЕ ИСТОРИИ ==========
+# Строки старше STATUS_RETENTION_DAYS сворачиваются в часовые и суточные status_rollups
+HOUR = 3600
+DAY = 24 * HOUR
+ROLLUP_PERIODS = (("hour", HOUR), ("day", DAY))
+RETENTION_START_DELAY = 60
+RETENTION_PAUSE = 0.05
+RETENTION_VACUUM_PAGES = 1000
+
+def add_status_time(rollups, user_id, status, start, end, hourly_since):
+    # Отрезок [start, end) пишется только в корзину его начала
+    if start >= end:
+        return
+    for period, size in ROLLUP_PERIODS:
+        bucket = start - start % size
+        if period == "hour" and bucket < hourly_since:
+            continue
+        rollups.setdefault((user_id, period, bucket, status), [0, 0])[0] += min(end, bucket + size) - start
+
+def add_status_transition(rollups, closings, user_id, status, at, hourly_since):
+    for period, size in ROLLUP_PERIODS:
+        bucket = at - at % size
+        if period == "hour" and bucket < hourly_since:
+            continue
+        rollups.setdefault((user_id, period, bucket, status), [0, 0])[1] += 1
+        closings[(user_id, period, bucket)] = status
+
+def save_status_rollups(conn, rollups, closings, carries):
+    conn.executemany('''
+        INSERT INTO status_rollups (user_id, period, bucket_start, status, seconds, transitions)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, period, bucket_start, status) DO UPDATE
+        SET seconds = seconds + excluded.seconds, transitions = transitions + excluded.transitions
+    ''', [key + tuple(values) for key, values in rollups.items()])
+    conn.executemany('''
+        UPDATE status_rollups SET closing = (status = ?)
+        WHERE user_id = ? AND period = ? AND bucket_start = ?
+    ''', [(status,) + key for key, status in closings.items()])
+    conn.executemany('''
+        INSERT INTO status_rollup_carry (user_id, status, since) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET status = excluded.status, since = excluded.since
+    ''', [(user_id, status, since) for user_id, (status, since) in carries.items()])
+
+def rollup_status_batch(conn, cutoff, hourly_since, limit):
+    # Открытый отрезок владельца ждет следующего перехода в status_rollup_carry
+    rows = conn.execute('''
+        SELECT id, user_id, status, CAST(strftime('%s', created_at) AS INTEGER) AS at
+        FROM server_statuses ORDER BY id LIMIT ?
+    ''', (limit,)).fetchall()
+    rows = list(itertools.takewhile(lambda row: row['at'] < cutoff, rows))
+    if not rows:
+        return 0
+    
+    rollups = {}
+    closings = {}
+    carries = {}
+    for row in rows:
+        user_id = row['user_id']
+        if user_id not in carries:
+            carry = conn.execute(
+                'SELECT status, since FROM status_rollup_carry WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            carries[user_id] = (carry['status'], carry['since']) if carry else None
+        carry = carries[user_id]
+        # Повторное нажатие того же статуса - не переход, отрезок продолжается
+        if carry and carry[0] == row['status']:
+            continue
+        if carry:
+            add_status_time(rollups, user_id, carry[0], carry[1], row['at'], hourly_since)
+        add_status_transition(rollups, closings, user_id, row['status'], row['at'], hourly_since)
+        carries[user_id] = (row['status'], max(row['at'], carry[1]) if carry else row['at'])
+    
+    save_status_rollups(conn, rollups, closings, carries)
+    conn.execute('DELETE FROM server_statuses WHERE id <= ?', (rows[-1]['id'],))
+    return len(rows)
+
+def prune_hourly_rollups(conn, hourly_since, after_user_id, limit):
+    # Последняя часовая корзина перед границей остается: ее closing еще нужен при чтении
+    user_ids = [row['user_id'] for row in conn.execute(
+        'SELECT user_id FROM status_rollup_carry WHERE user_id > ? ORDER BY user_id LIMIT ?',
+        (after_user_id, limit)
+    )]
+    if not user_ids:
+        return None
+    deleted = conn.executemany(
+        '''
+        DELETE FROM status_rollups WHERE user_id = ? AND period = 'hour' AND bucket_start < (
+            SELECT MAX(bucket_start) FROM status_rollups
+            WHERE user_id = ? AND period = 'hour' AND bucket_start < ?
+        )
+        ''',
+        [(user_id, user_id, hourly_since) for user_id in user_ids]
+    ).rowcount
+    return user_ids[-1], deleted
+
+def vacuum_free_pages(conn, pages):
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if not free:
+        return 0
+    # Прагма освобождает по странице на шаг, ее нужно дочитать до конца
+    conn.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+    return free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def convert_auto_vacuum():
+    # Полный VACUUM старой базы делает один процесс, взявший файловую блокировку
+    conn = open_db_connection()
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        with open(DATABASE_PATH + '.maintenance', 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+                logger.info("🗄️ Включен auto_vacuum=INCREMENTAL")
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Не удалось включить auto_vacuum: {e}")
+    finally:
+        conn.close()
+
+def optimize_db(conn):
+    # ANALYZE только тех таблиц, где он нужен, с ограничением на объем выборки
+    conn.execute('PRAGMA analysis_limit=1000')
+    conn.execute('PRAGMA optimize').fetchall()
+
+class RetentionEngine:
+    def __init__(self, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.started = False
+    
+    def start(self):
+        if self.interval <= 0 or self.started:
+            return
+        self.started = True
+        Thread(target=self.run, name="retention", daemon=True).start()
+    
+    def run(self):
+        time.sleep(RETENTION_START_DELAY)
+        convert_auto_vacuum()
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"💥 Ошибка обслуживания истории: {e}")
+            time.sleep(self.interval)
+    
+    def repeat(self, func, *args):
+        # Шаги с паузами, чтобы обработчики успевали между пачками
+        while True:
+            result = db_writer.call(func, *args).result()
+            if not result:
+                return
+            yield result
+            time.sleep(RETENTION_PAUSE)
+    
+    def run_once(self, now=None):
+        now = int(now or time.time())
+        # Граница по целому часу: свернутые часовые корзины уже не дополняются
+        cutoff = now - int(STATUS_RETENTION_DAYS * DAY)
+        cutoff -= cutoff % HOUR
+        # Часовые корзины удаляются целыми сутками
+        hourly_since = now - int(ROLLUP_HOURLY_DAYS * DAY)
+        hourly_since -= hourly_since % DAY
+        
+        rolled = sum(self.repeat(rollup_status_batch, cutoff, hourly_since, self.batch_size))
+        
+        pruned = 0
+        after_user_id = 0
+        while True:
+            step = db_writer.call(prune_hourly_rollups, hourly_since, after_user_id, self.batch_size).result()
+            if not step:
+                break
+            after_user_id, deleted = step
+            pruned += deleted
+        
+        db_writer.execute('DELETE FROM subscription_changes WHERE created_at < ?', (now - SUBSCRIPTION_CHANGES_TTL,)).result()
+        pages = sum(self.repeat(vacuum_free_pages, RETENTION_VACUUM_PAGES))
+        db_writer.call(optimize_db).result()
+        logger.info(f"🧹 История: свернуто строк {rolled}, удалено часовых сверток {pruned}, освобождено страниц {pages}")
+        return rolled, pruned, pages
+
+retention_engine = RetentionEngine()
+
 # ========== АДМИН-ФУНКЦИИ ==========
 def get_all_users():
     conn = get_db_connection()
     users = conn.execute('''
-        SELECT u.*, 
-               (SELECT status FROM server_statuses ss 
-                WHERE ss.user_id = u.user_id 
-                ORDER BY ss.created_at DESC LIMIT 1) as last_status,
-               (SELECT COUNT(*) FROM subscriptions s WHERE s.target_user_id = u.user_id) as subscribers_count
+        SELECT u.*, cs.status as last_status, COALESCE(sc.count, 0) as subscribers_count
         FROM users u
+        LEFT JOIN current_status cs ON cs.user_id = u.user_id
+        LEFT JOIN subscriber_counts sc ON sc.target_user_id = u.user_id
     ''').fetchall()
-    conn.close()
     return users
 
+# Рассылка хранится в SQLite как задача: курсор по user_id, исход по каждому
+# получателю и счетчики. Задачу выполняет тот процесс, который держит аренду
+# (lease_until, lease_owner); после падения или ошибки периодическая проверка
+# подхватит ее с курсора, как только аренда истечет.
+# Повторно может уйти не больше одной пачки BROADCAST_BATCH_SIZE
+BROADCAST_SWEEP_INTERVAL = 60
+broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+
+def insert_broadcast_job(conn, text):
+    total = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
+    job_id = conn.execute('INSERT INTO broadcast_jobs (text, total) VALUES (?, ?)', (text, total)).lastrowid
+    return job_id, total
+
 def broadcast_message(text):
+    job_id, total = db_writer.call(insert_broadcast_job, text).result()
+    
+    broadcast_executor.submit(run_broadcast_job, job_id)
+    logger.info(f"📢 Рассылка #{job_id} создана, получателей: {total}")
+    return job_id
+
+def lease_broadcast_job(conn, job_id, owner, now):
+    return conn.execute('''
+        UPDATE broadcast_jobs
+        SET status = 'running', lease_until = ?, lease_owner = ?, started_at = COALESCE(started_at, ?)
+        WHERE id = ? AND status IN ('pending', 'running') AND lease_until < ?
+    ''', (now + BROADCAST_LEASE, owner, now, job_id, now)).rowcount
+
+def claim_broadcast_job(job_id):
+    # Свой токен на каждый захват: повторный запуск в том же процессе тоже чужой
+    owner = secrets.token_hex(16)
+    claimed = db_writer.call(lease_broadcast_job, job_id, owner, time.time()).result()
+    return owner if claimed == 1 else None
+
+def record_broadcast_batch(conn, job_id, owner, cursor, outcomes, counts):
+    # Курсор и исходы пишет только владелец аренды
+    advanced = conn.execute('''
+        UPDATE broadcast_jobs
+        SET cursor = ?, delivered = delivered + ?, blocked = blocked + ?, failed = failed + ?, lease_until = ?
+        WHERE id = ? AND lease_owner = ?
+    ''', (cursor, counts['sent'], counts['blocked'], counts['failed'],
+          time.time() + BROADCAST_LEASE, job_id, owner)).rowcount
+    if advanced:
+        conn.executemany(
+            'INSERT OR REPLACE INTO broadcast_recipients (job_id, user_id, outcome) VALUES (?, ?, ?)',
+            outcomes
+        )
+    return advanced
+
+def run_broadcast_job(job_id):
+    owner = claim_broadcast_job(job_id)
+    if not owner:
+        return
+    
+    try:
+        conn = get_db_connection()
+        text = conn.execute('SELECT text FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()['text']
+        body = encode_payload({"text": text, "parse_mode": "HTML"})
+        
+        while True:
+            conn = get_db_connection()
+            job = conn.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+            batch = conn.execute(
+                'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                (job['cursor'], BROADCAST_BATCH_SIZE)
+            ).fetchall()
+            
+            if not batch:
+                break
+            
+            futures = [(user['user_id'], schedule_encoded_message(user['user_id'], body)) for user in batch]
+            outcomes = [(job_id, user_id, classify_send_result(wait_outbound(future))) for user_id, future in futures]
+            counts = {"sent": 0, "blocked": 0, "failed": 0}
+            for _, _, outcome in outcomes:
+                counts[outcome] += 1
+            
+            advanced = db_writer.call(
+                record_broadcast_batch, job_id, owner, batch[-1]['user_id'], outcomes, counts).result()
+            if not advanced:
+                # Аренда истекла и перешла к другому процессу: курсор теперь его
+                logger.warning(f"⚠️ Рассылка #{job_id} перешла к другому процессу")
+                return
+        
+        db_writer.execute('''
+            UPDATE broadcast_jobs
+            SET status = 'done', finished_at = ?, total = delivered + blocked + failed, lease_until = 0
+            WHERE id = ? AND lease_owner = ?
+        ''', (time.time(), job_id, owner)).result()
+        logger.info(f"✅ Рассылка #{job_id} завершена")
+    except Exception as e:
+        # Аренда истечет, и задачу подхватит sweep_broadcast_jobs
+        rollback_db_connection()
+        logger.error(f"❌ Ошибка рассылки #{job_id}: {e}")
+
+def resume_broadcast_jobs():
     conn = get_db_connection()
-    users = conn.execute('SELECT user_id FROM users').fetchall()
-    conn.close()
+    jobs = conn.execute(
+        "SELECT id FROM broadcast_jobs WHERE status IN ('pending', 'running') AND lease_until < ?",
+        (time.time(),)
+    ).fetchall()
+    
+    for job in jobs:
+        logger.info(f"🔁 Возобновление рассылки #{job['id']}")
+        broadcast_executor.submit(run_broadcast_job, job['id'])
+
+def sweep_broadcast_jobs():
+    while True:
+        time.sleep(BROADCAST_SWEEP_INTERVAL)
+        try:
+            resume_broadcast_jobs()
+        except Exception as e:
+            rollback_db_connection()
+            logger.error(f"❌ Ошибка проверки рассылок: {e}")
+
+def start_broadcast_jobs():
+    resume_broadcast_jobs()
+    Thread(target=sweep_broadcast_jobs, name="broadcast-sweep", daemon=True).start()
+
+def get_latest_broadcast_job():
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1').fetchone()
+    return job
+
+def format_broadcast_progress(job):
+    if not job:
+        return "📢 Рассылок еще не было"
     
-    success_count = 0
-    for user in users:
-        if send_message(user['user_id'], text):
-            success_count += 1
+    processed = job['delivered'] + job['blocked'] + job['failed']
+    total = max(job['total'], processed)
+    elapsed = ((job['finished_at'] or time.time()) - job['started_at']) if job['started_at'] else 0
+    rate = processed / elapsed if elapsed > 0 else 0
+    state_names = {"pending": "⏳ в очереди", "running": "🔄 идет", "done": "✅ завершена"}
     
-    return success_count
+    text = (
+        f"📢 <b>Рассылка #{job['id']}</b>: {state_names.get(job['status'], job['status'])}\n\n"
+        f"📨 Обработано: {processed} из {total}"
+        f" ({processed * 100 // total if total else 100}%)\n"
+        f"✅ Доставлено: {job['delivered']}\n"
+        f"🚫 Заблокировали бота: {job['blocked']}\n"
+        f"❌ Ошибки: {job['failed']}\n"
+        f"⚡ Скорость: {rate:.1f} сообщ./с"
+    )
+    if job['status'] != 'done' and rate > 0:
+        text += f"\n⏳ Осталось: ~{int((total - processed) / rate)} с"
+    return text
 
 def set_bot_status(enabled, reason=""):
     global bot_enabled, bot_disable_reason
     bot_enabled = enabled
     bot_disable_reason = reason
 
+# ========== ШАБЛОНЫ ==========
+# Таблицы статусов и шаблоны текстов собираются один раз при импорте;
+# при отрисовке остается только подставить значения
+STATUS_EMOJIS = {
+    "status_on": "🟢",
+    "status_pause": "🟡",
+    "status_off": "🔴",
+    "status_unknown": "❓"
+}
+
+STATUS_NAMES = {
+    "status_on": "ВКЛЮЧЕН",
+    "status_pause": "ПРИОСТАНОВЛЕН",
+    "status_off": "ВЫКЛЮЧЕН",
+    "status_unknown": "НЕИЗВЕСТНО"
+}
+
+STATUS_LABELS = {status: f"{STATUS_EMOJIS[status]} {name}" for status, name in STATUS_NAMES.items()}
+
+# Всплывающие подсказки при нажатии кнопок; для остальных кнопок ответ пустой
+CALLBACK_TOASTS = {status: f"Статус: {label}" for status, label in STATUS_LABELS.items()}
+
+render_status_message = (
+    "{emoji} <b>Статус {server_info}</b>\n\n"
+    "📊 Статус: <b>{name}</b>\n"
+    "👤 Владелец: {owner}\n"
+    "👥 Подписчиков: {subscriber_count}\n"
+    "⏰ Обновлено: {time}\n\n"
+    "💡 Используйте бота для управления статусом"
+).format
+
+render_status_notification = (
+    "🔔 <b>Изменение статуса {server_info}</b>\n\n"
+    "Владелец: <b>{owner}</b>\n"
+    "Новый статус: {label}\n"
+    "⏰ Время: {time}"
+).format
+
+render_main_menu = (
+    "🤖 <b>Управление статусами</b>\n\n"
+    "🏷️ <b>Текущий объект:</b> {server_info}\n"
+    "📋 Группа: {group_name}\n"
+    "💬 Сообщение: {message}\n"
+    "🏷️ Тема: {thread}\n"
+    "⏰ Часовой пояс: {timezone}\n\n"
+    "<b>Доступные функции:</b>\n"
+    "• ⚡ Управление статусом\n"
+    "• 📝 Отправка сообщений в группу\n"
+    "• 📊 Просмотр статистики\n"
+    "• 📈 История изменений\n"
+    "• 🔔 Управление подписками\n"
+    "• ⚙️ Настройки\n\n"
+    "⏰ Ваше время: {time}"
+).format
+
+MAIN_MENU_NOT_CONFIGURED_TEXT = "❌ <b>Бот не настроен</b>\n\nИспользуйте настройки для конфигурации"
+
+render_stats = (
+    "📊 <b>Глобальная статистика</b>\n\n"
+    "Всего объектов: {total}\n\n"
+    "Статусы:\n{status_text}\n"
+    "⏰ Обновлено: {time}"
+).format
+
 # ========== КНОПКИ ==========
+# Постоянные клавиатуры создаются один раз, и их reply_markup
+# сериализуется заранее; меняются только кнопки настроек
+class StaticKeyboard(list):
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.markup = encode_json({"inline_keyboard": rows})
+
+MAIN_MENU_BUTTONS = StaticKeyboard([
+    [{"text": "⚡ Управление статусом", "callback_data": "manage_status"}],
+    [{"text": "📝 Отправить сообщение", "callback_data": "send_message"}],
+    [{"text": "📊 Статистика", "callback_data": "stats"}],
+    [{"text": "📈 История", "callback_data": "history"}],
+    [{"text": "🔔 Подписки", "callback_data": "subscriptions"}],
+    [{"text": "⚙️ Настройки", "callback_data": "settings"}]
+])
+
+STATUS_BUTTONS = StaticKeyboard([
+    [
+        {"text": "🟢 Включен", "callback_data": "status_on"},
+        {"text": "🟡 Приостановлен", "callback_data": "status_pause"}
+    ],
+    [
+        {"text": "🔴 Выключен", "callback_data": "status_off"},
+        {"text": "❓ Неизвестно", "callback_data": "status_unknown"}
+    ],
+    [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
+])
+
+ADMIN_BUTTONS = StaticKeyboard([
+    [{"text": "👥 Все пользователи", "callback_data": "admin_users"}],
+    [{"text": "📢 Рассылка", "callback_data": "admin_broadcast"}],
+    [{"text": "📊 Прогресс рассылки", "callback_data": "admin_broadcast_status"}],
+    [{"text": "🔧 Управление ботом", "callback_data": "admin_manage_bot"}],
+    [{"text": "🚪 Выйти из админки", "callback_data": "admin_logout"}],
+    [{"text": "🔙 Назад", "callback_data": "back_to_settings"}]
+])
+
+WELCOME_BUTTONS = StaticKeyboard([
+    [{"text": "📋 Начать настройку", "callback_data": "start_setup"}],
+    [{"text": "🚀 Быстрая настройка", "callback_data": "quick_setup"}],
+    [{"text": "🔍 Как найти thread_id?", "callback_data": "help_thread_id"}],
+    [{"text": "🔄 Перезапустить настройку", "callback_data": "restart_setup"}]
+])
+
+CREATE_MESSAGE_BUTTONS = StaticKeyboard([
+    [{"text": "📝 Создать сообщение", "callback_data": "create_status_message"}],
+    [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
+])
+
+BACK_BUTTONS = StaticKeyboard([[{"text": "🔙 Назад", "callback_data": "back_to_main"}]])
+
+RETRY_SETUP_BUTTONS = StaticKeyboard([
+    [{"text": "🔄 Попробовать снова", "callback_data": "restart_setup"}],
+    [{"text": "📋 Ручная настройка", "callback_data": "start_setup"}],
+    [{"text": "🚀 Быстрая настройка", "callback_data": "quick_setup"}],
+    [{"text": "❌ Отмена", "callback_data": "back_to_main"}]
+])
+
+MISSING_MESSAGE_BUTTONS = StaticKeyboard([
+    [{"text": "📝 Создать сообщение", "callback_data": "create_status_message"}],
+    [{"text": "⚙️ Настроить сообщение", "callback_data": "change_group_settings"}],
+    [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
+])
+
+SETTINGS_ONLY_BUTTONS = StaticKeyboard([[{"text": "⚙️ Настройки", "callback_data": "settings"}]])
+
 def get_main_menu_buttons():
-    return [
-        [{"text": "⚡ Управление статусом", "callback_data": "manage_status"}],
-        [{"text": "📝 Отправить сообщение", "callback_data": "send_message"}],
-        [{"text": "📊 Статистика", "callback_data": "stats"}],
-        [{"text": "📈 История", "callback_data": "history"}],
-        [{"text": "🔔 Подписки", "callback_data": "subscriptions"}],
-        [{"text": "⚙️ Настройки", "callback_data": "settings"}]
-    ]
+    return MAIN_MENU_BUTTONS
 
 def get_status_buttons():
-    return [
-        [
-            {"text": "🟢 Включен", "callback_data": "status_on"},
-            {"text": "🟡 Приостановлен", "callback_data": "status_pause"}
-        ],
-        [
-            {"text": "🔴 Выключен", "callback_data": "status_off"},
-            {"text": "❓ Неизвестно", "callback_data": "status_unknown"}
-        ],
-        [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
-    ]
+    return STATUS_BUTTONS
 
 def get_settings_buttons(user_id):
     buttons = [
@@ -505,38 +2456,70 @@ def get_settings_buttons(user_id):
     return buttons
 
 def get_admin_buttons():
-    return [
-        [{"text": "👥 Все пользователи", "callback_data": "admin_users"}],
-        [{"text": "📢 Рассылка", "callback_data": "admin_broadcast"}],
-        [{"text": "🔧 Управление ботом", "callback_data": "admin_manage_bot"}],
-        [{"text": "🚪 Выйти из админки", "callback_data": "admin_logout"}],
-        [{"text": "🔙 Назад", "callback_data": "back_to_settings"}]
-    ]
+    return ADMIN_BUTTONS
 
 def get_welcome_buttons():
-    return [
-        [{"text": "📋 Начать настройку", "callback_data": "start_setup"}],
-        [{"text": "🚀 Быстрая настройка", "callback_data": "quick_setup"}],
-        [{"text": "🔍 Как найти thread_id?", "callback_data": "help_thread_id"}],
-        [{"text": "🔄 Перезапустить настройку", "callback_data": "restart_setup"}]
-    ]
+    return WELCOME_BUTTONS
 
 def get_create_message_buttons():
-    return [
-        [{"text": "📝 Создать сообщение", "callback_data": "create_status_message"}],
-        [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
-    ]
+    return CREATE_MESSAGE_BUTTONS
 
 def get_back_button():
-    return [[{"text": "🔙 Назад", "callback_data": "back_to_main"}]]
+    return BACK_BUTTONS
 
 def get_retry_setup_buttons():
-    return [
-        [{"text": "🔄 Попробовать снова", "callback_data": "restart_setup"}],
-        [{"text": "📋 Ручная настройка", "callback_data": "start_setup"}],
-        [{"text": "🚀 Быстрая настройка", "callback_data": "quick_setup"}],
-        [{"text": "❌ Отмена", "callback_data": "back_to_main"}]
-    ]
+    return RETRY_SETUP_BUTTONS
+
+# ========== МАРШРУТИЗАЦИЯ ==========
+# Обработчики регистрируются декораторами в таблицах: точные callback_data,
+# префиксы до первого "_" (subscribe_<id>, status_<...>), шаги диалога и
+# команды. Выбор обработчика - один поиск в словаре, а время каждого
+# маршрута попадает в гистограмму bot_route_seconds
+callback_routes = {}
+callback_prefix_routes = {}
+message_state_routes = {}
+command_routes = {}
+
+def callback_route(data):
+    def decorator(handler):
+        callback_routes[data] = handler
+        return handler
+    return decorator
+
+def callback_prefix(prefix):
+    def decorator(handler):
+        callback_prefix_routes[prefix] = handler
+        return handler
+    return decorator
+
+def state_route(state):
+    def decorator(handler):
+        message_state_routes[state] = handler
+        return handler
+    return decorator
+
+def command_route(*commands):
+    def decorator(handler):
+        for command in commands:
+            command_routes[command] = handler
+        return handler
+    return decorator
+
+def admin_required(handler):
+    # Без прав админа обработчик молча пропускается (возвращает None)
+    @wraps(handler)
+    def wrapper(user_id, *args):
+        if int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
+            return handler(user_id, *args)
+        return None
+    return wrapper
+
+def dispatch_route(route, handler, *args):
+    start = time.perf_counter()
+    try:
+        return handler(*args)
+    finally:
+        route_latency.observe(time.perf_counter() - start, route)
 
 # ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
 def validate_group_settings_input(text):
@@ -571,275 +2554,21 @@ def process_message(message):
     if user_id != chat_id:
         return False
     
-    if user_id in user_states:
-        state = user_states[user_id]
-        
-        if state == "waiting_group_settings":
-            is_valid, validation_result = validate_group_settings_input(text)
-            
-            if not is_valid:
-                send_message(user_id, 
-                           f"{validation_result}\n\n"
-                           "💡 <b>Пример правильного формата:</b>\n"
-                           "<code>-100123456789,,123,Мой Сервер</code>\n\n"
-                           "Хотите попробовать снова?",
-                           get_retry_setup_buttons())
-                user_states[user_id] = None
-                return True
-            
-            group_id, thread_id, message_id, group_name = validation_result
-            
-            try:
-                setup_user_settings(user_id, group_id, thread_id, message_id, group_name)
-                user_states[user_id] = "waiting_server_info_initial"
-                send_message(user_id, 
-                            f"✅ Группа '{group_name}' настроена!\n"
-                            f"💬 Бот будет редактировать сообщение: {message_id}\n\n"
-                            "🔗 <b>Теперь настройте название или ссылку:</b>\n\n"
-                            "Введите название или ссылку для отображения в статусе:\n\n"
-                            "💡 <b>Примеры:</b>\n"
-                            "• <code>Мой Minecraft Сервер</code>\n"
-                            "• <code>https://myserver.com</code>\n"
-                            "• <code>Discord сервер</code>\n"
-                            "• <code>t.me/mychannel</code>\n\n"
-                            "Или отправьте <code>пропустить</code> для значения по умолчанию\n"
-                            "Или <code>назад</code> чтобы вернуться к настройке группы",
-                            [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
-                
-            except Exception as e:
-                send_message(user_id, 
-                           f"❌ <b>Ошибка сохранения настроек!</b>\n\n"
-                           f"Причина: {str(e)}\n\n"
-                           "Попробуйте снова:",
-                           get_retry_setup_buttons())
-                user_states[user_id] = None
-            
-            return True
-            
-        elif state == "waiting_server_info_initial":
-            if text.lower() == "назад":
-                user_states[user_id] = "waiting_group_settings"
-                send_message(user_id,
-                            "🔙 <b>Возврат к настройке группы</b>\n\n"
-                            "Введите данные в формате:\n"
-                            "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
-                            "Пример:\n"
-                            "<code>-100123456789,,123,Мой Сервер</code>",
-                            [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
-                return True
-            
-            server_info = text if text.lower() != "пропустить" else "Сервер"
-            
-            try:
-                conn = get_db_connection()
-                conn.execute('UPDATE users SET server_info = ? WHERE user_id = ?', (server_info, user_id))
-                conn.commit()
-                conn.close()
-                
-                send_message(user_id, 
-                            f"✅ <b>Настройка завершена!</b>\n\n"
-                            f"🏷️ Объект: <b>{server_info}</b>\n"
-                            f"📋 Группа: {get_group_name(user_id)}\n"
-                            f"💬 Сообщение: {get_message_id(user_id)}\n\n"
-                            f"Теперь вы можете управлять статусом {server_info}",
-                            buttons=get_main_menu_buttons())
-                
-                user_states[user_id] = None
-                
-            except Exception as e:
-                send_message(user_id,
-                            f"❌ <b>Ошибка сохранения!</b>\n\n"
-                            f"Причина: {str(e)}\n\n"
-                            "Попробуйте ввести название снова:",
-                            [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
-            
-            return True
-            
-        elif state == "waiting_broadcast" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-            success_count = broadcast_message(text)
-            send_message(user_id, f"✅ Рассылка отправлена {success_count} пользователям!", buttons=get_admin_buttons())
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_timezone":
-            try:
-                pytz.timezone(text)
-                conn = get_db_connection()
-                conn.execute('UPDATE users SET timezone = ? WHERE user_id = ?', (text, user_id))
-                conn.commit()
-                conn.close()
-                send_message(user_id, f"✅ Часовой пояс изменен на: {text}", buttons=get_settings_buttons(user_id))
-            except:
-                send_message(user_id, "❌ Неверный часовой пояс. Используйте формат: Europe/Moscow", buttons=get_settings_buttons(user_id))
-            
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_group_message":
-            conn = get_db_connection()
-            user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-            conn.close()
-            
-            if user:
-                result = send_message(
-                    user['group_id'], 
-                    text,
-                    thread_id=user['thread_id'] if user['thread_id'] else None
-                )
-                
-                if result and result.get('ok'):
-                    send_message(user_id, "✅ Сообщение успешно отправлено в группу!", buttons=get_main_menu_buttons())
-                else:
-                    send_message(user_id, "❌ Не удалось отправить сообщение. Проверьте права бота.", buttons=get_main_menu_buttons())
-            else:
-                send_message(user_id, "❌ Ошибка: данные группы не найдены.", buttons=get_main_menu_buttons())
-            
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_disable_reason" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-            set_bot_status(False, text)
-            send_message(user_id, f"🔴 Бот выключен. Причина: {text}", buttons=get_admin_buttons())
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_server_info":
-            conn = get_db_connection()
-            conn.execute('UPDATE users SET server_info = ? WHERE user_id = ?', (text, user_id))
-            conn.commit()
-            conn.close()
-            
-            send_message(user_id, 
-                        f"✅ Название/ссылка успешно изменена!\n\n"
-                        f"Теперь в статусе будет отображаться: <b>{text}</b>",
-                        buttons=get_settings_buttons(user_id))
-            
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_admin_password":
-            if authenticate_admin(user_id, text):
-                send_message(user_id, "✅ <b>Доступ разрешен!</b>\n\nДобро пожаловать в админ-панель!", buttons=get_admin_buttons())
-                show_admin_panel(user_id)
-            else:
-                send_message(user_id, "❌ <b>Неверный пароль!</b>\n\nПопробуйте еще раз или вернитесь в меню.", 
-                           [[{"text": "🔐 Попробовать снова", "callback_data": "admin_login"}],
-                            [{"text": "🔙 В главное меню", "callback_data": "back_to_main"}]])
-            
-            user_states[user_id] = None
-            return True
-            
-        elif state == "waiting_group_id_for_setup":
-            try:
-                group_id = int(text)
-                
-                if group_id >= 0:
-                    send_message(user_id,
-                                "❌ <b>Неверный ID группы!</b>\n\n"
-                                "ID группы должен быть отрицательным числом (начинаться с -100).\n\n"
-                                "Примеры правильных ID:\n"
-                                "• <code>-100123456789</code>\n"
-                                "• <code>-100987654321</code>\n\n"
-                                "Попробуйте снова:",
-                                get_retry_setup_buttons())
-                    user_states[user_id] = None
-                    return True
-                
-                success, result = create_and_setup_message(user_id, group_id)
-                
-                if success:
-                    send_message(user_id,
-                                f"✅ <b>Автонастройка завершена!</b>\n\n"
-                                f"📋 Группа ID: {group_id}\n"
-                                f"💬 Создано сообщение: {result}\n\n"
-                                f"🤖 Бот автоматически настроен и готов к работе!",
-                                buttons=get_main_menu_buttons())
-                    user_states[user_id] = None
-                else:
-                    send_message(user_id,
-                                f"❌ <b>Ошибка автонастройки!</b>\n\n"
-                                f"{result}\n\n"
-                                "Выберите действие:",
-                                get_retry_setup_buttons())
-                    user_states[user_id] = None
-                
-            except ValueError:
-                send_message(user_id, 
-                            "❌ <b>Неверный формат!</b>\n\n"
-                            "ID группы должен быть числом.\n"
-                            "Пример: <code>-100123456789</code>\n\n"
-                            "Попробуйте снова:",
-                            get_retry_setup_buttons())
-                user_states[user_id] = None
-            except Exception as e:
-                send_message(user_id, 
-                            f"❌ <b>Неизвестная ошибка!</b>\n\n"
-                            f"Причина: {str(e)}\n\n"
-                            "Попробуйте снова:",
-                            get_retry_setup_buttons())
-                user_states[user_id] = None
-            
-            return True
-    
-    if text == "/start":
-        reset_user_settings(user_id)
-        
-        welcome_text = (
-            "🔄 <b>Бот полностью перезагружен!</b>\n\n"
-            "🤖 <b>Добро пожаловать в бот управления статусами!</b>\n\n"
-            "📋 <b>Выберите способ настройки:</b>\n\n"
-            "🚀 <b>Быстрая настройка</b> (рекомендуется):\n"
-            "• Бот сам создаст сообщение в группе\n"
-            "• Автоматическая настройка\n"
-            "• Просто укажите ID группы\n\n"
-            "📋 <b>Ручная настройка</b>:\n"
-            "• Полный контроль над настройками\n"
-            "• Указание всех параметров вручную\n\n"
-            "💡 <b>Что можно отслеживать?</b>\n"
-            "• Серверы (Minecraft, Discord и др.)\n"
-            "• Сайты и приложения\n" 
-            "• Telegram каналы и боты\n"
-            "• Любые другие объекты!"
-        )
-        
-        send_message(user_id, welcome_text, get_welcome_buttons())
-        logger.info(f"🔄 Пользователь {user_id} выполнил /start")
-        return True
-        
-    elif text == "/admin":
-        if int(user_id) == int(ADMIN_USER_ID):
-            if is_admin_authenticated(user_id):
-                show_admin_panel(user_id)
-                logger.info(f"👑 Админ {user_id} открыл панель")
-            else:
-                user_states[user_id] = "waiting_admin_password"
-                send_message(user_id, 
-                           "🔐 <b>Аутентификация администратора</b>\n\n"
-                           "Введите пароль для доступа к админ-панели:",
-                           [[{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
-        else:
-            send_message(user_id, "❌ <b>Доступ запрещен</b>\n\nЭта команда только для администратора.")
-        return True
-        
-    elif text == "/stats":
-        show_stats(user_id)
-        return True
-        
-    elif text == "/settings":
-        show_settings(user_id)
-        return True
+    state = user_states.get(user_id)
+    handler = message_state_routes.get(state) if state else None
+    if handler:
+        # Обработчик, вернувший None (например, без прав админа), передает
+        # сообщение дальше командам, как раньше
+        result = dispatch_route(f"state:{state}", handler, user_id, text)
+        if result is not None:
+            return result
     
-    elif text.lower() in ["/restart", "/reset", "перезапустить", "сбросить"]:
-        reset_user_settings(user_id)
-        send_message(user_id,
-                    "🔄 <b>Настройки сброшены!</b>\n\n"
-                    "Вы можете начать настройку заново:",
-                    get_welcome_buttons())
-        return True
+    command = text.lower()
+    handler = command_routes.get(command)
+    if handler:
+        return dispatch_route(f"command:{command}", handler, user_id, text)
     
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = get_user(user_id)
     
     if user:
         show_main_menu(user_id)
@@ -851,310 +2580,619 @@ def process_message(message):
     
     return True
 
-def get_group_name(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT group_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
-    return user['group_name'] if user else 'Неизвестно'
-
-def get_message_id(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT message_id FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
-    return user['message_id'] if user else 'Неизвестно'
-
-def process_callback(callback):
-    user_id = callback["from"]["id"]
-    data = callback["data"]
-    message_id = callback["message"]["message_id"]
+@state_route("waiting_group_settings")
+def state_group_settings(user_id, text):
+    is_valid, validation_result = validate_group_settings_input(text)
     
-    answer_callback(callback["id"])
-    
-    if data == "restart_setup":
-        if user_id in user_states:
-            del user_states[user_id]
-        
-        edit_message(user_id, message_id,
-                    "🔄 <b>Настройка перезапущена!</b>\n\n"
-                    "Выберите способ настройки:",
-                    get_welcome_buttons())
+    if not is_valid:
+        send_message(user_id, 
+                   f"{validation_result}\n\n"
+                   "💡 <b>Пример правильного формата:</b>\n"
+                   "<code>-100123456789,,123,Мой Сервер</code>\n\n"
+                   "Хотите попробовать снова?",
+                   get_retry_setup_buttons())
+        user_states.set(user_id, None)
         return True
     
-    elif data == "quick_setup":
-        user_states[user_id] = "waiting_group_id_for_setup"
-        edit_message(user_id, message_id,
-                    "🚀 <b>Быстрая настройка</b>\n\n"
-                    "📋 <b>Для автоматической настройки:</b>\n\n"
-                    "1. Добавьте бота в вашу группу\n"
-                    "2. Дайте боту права администратора\n"
-                    "3. Укажите ID группы ниже\n\n"
-                    "💡 <b>Как найти ID группы?</b>\n"
-                    "• Добавьте @RawDataBot в группу\n"
-                    "• Он покажет ID группы (начинается с -100)\n\n"
-                    "📝 Введите ID группы:\n\n"
-                    "💡 <b>Пример:</b> <code>-100123456789</code>",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
-        return True
+    group_id, thread_id, message_id, group_name = validation_result
     
-    elif data == "admin_login":
-        if int(user_id) == int(ADMIN_USER_ID):
-            user_states[user_id] = "waiting_admin_password"
-            edit_message(user_id, message_id,
-                        "🔐 <b>Аутентификация администратора</b>\n\n"
-                        "Введите пароль для доступа к админ-панели:",
-                        [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                         [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
-        else:
-            send_message(user_id, "❌ Доступ запрещен")
-        return True
+    try:
+        setup_user_settings(user_id, group_id, thread_id, message_id, group_name)
+        user_states.set(user_id, "waiting_server_info_initial")
+        send_message(user_id, 
+                    f"✅ Группа '{group_name}' настроена!\n"
+                    f"💬 Бот будет редактировать сообщение: {message_id}\n\n"
+                    "🔗 <b>Теперь настройте название или ссылку:</b>\n\n"
+                    "Введите название или ссылку для отображения в статусе:\n\n"
+                    "💡 <b>Примеры:</b>\n"
+                    "• <code>Мой Minecraft Сервер</code>\n"
+                    "• <code>https://myserver.com</code>\n"
+                    "• <code>Discord сервер</code>\n"
+                    "• <code>t.me/mychannel</code>\n\n"
+                    "Или отправьте <code>пропустить</code> для значения по умолчанию\n"
+                    "Или <code>назад</code> чтобы вернуться к настройке группы",
+                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
         
-    elif data == "admin_logout":
-        if int(user_id) == int(ADMIN_USER_ID):
-            logout_admin(user_id)
-            edit_message(user_id, message_id,
-                        "✅ <b>Выход выполнен</b>\n\n"
-                        "Вы вышли из админ-панели.",
-                        get_settings_buttons(user_id))
-        return True
+    except Exception as e:
+        send_message(user_id, 
+                   f"❌ <b>Ошибка сохранения настроек!</b>\n\n"
+                   f"Причина: {str(e)}\n\n"
+                   "Попробуйте снова:",
+                   get_retry_setup_buttons())
+        user_states.set(user_id, None)
     
-    elif data == "send_message":
-        show_send_message_menu(user_id, message_id)
-        return True
-        
-    elif data == "history":
-        show_history(user_id, message_id)
-        return True
-        
-    elif data == "subscriptions":
-        show_subscriptions_menu(user_id, message_id)
-        return True
-        
-    elif data.startswith("subscribe_"):
-        target_user_id = int(data.split("_")[1])
-        if subscribe_to_server(user_id, target_user_id):
-            send_message(user_id, "✅ Вы успешно подписались на сервер!")
-        show_subscriptions_menu(user_id, message_id)
+    return True
+
+@state_route("waiting_server_info_initial")
+def state_server_info_initial(user_id, text):
+    if text.lower() == "назад":
+        user_states.set(user_id, "waiting_group_settings")
+        send_message(user_id,
+                    "🔙 <b>Возврат к настройке группы</b>\n\n"
+                    "Введите данные в формате:\n"
+                    "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
+                    "Пример:\n"
+                    "<code>-100123456789,,123,Мой Сервер</code>",
+                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
         return True
+    
+    server_info = text if text.lower() != "пропустить" else "Сервер"
+    
+    try:
+        db_writer.execute('UPDATE users SET server_info = ? WHERE user_id = ?', (server_info, user_id)).result()
+        invalidate_user(user_id)
         
-    elif data.startswith("unsubscribe_"):
-        target_user_id = int(data.split("_")[1])
-        if unsubscribe_from_server(user_id, target_user_id):
-            send_message(user_id, "✅ Вы отписались от сервера")
-        show_subscriptions_menu(user_id, message_id)
-        return True
+        send_message(user_id, 
+                    f"✅ <b>Настройка завершена!</b>\n\n"
+                    f"🏷️ Объект: <b>{server_info}</b>\n"
+                    f"📋 Группа: {get_group_name(user_id)}\n"
+                    f"💬 Сообщение: {get_message_id(user_id)}\n\n"
+                    f"Теперь вы можете управлять статусом {server_info}",
+                    buttons=get_main_menu_buttons())
         
-    elif data == "unsubscribe_all":
-        if unsubscribe_from_all(user_id):
-            send_message(user_id, "✅ Вы отписались от всех серверов")
-        show_subscriptions_menu(user_id, message_id)
-        return True
+        user_states.set(user_id, None)
         
-    elif data == "change_server_info":
-        user_states[user_id] = "waiting_server_info"
-        current_info = get_user_server_info(user_id)
-        edit_message(user_id, message_id,
-                    f"🔗 <b>Изменение названия/ссылки</b>\n\n"
-                    f"Текущее значение: <b>{current_info}</b>\n\n"
-                    "Введите новое название или ссылку:\n\n"
-                    "💡 <b>Примеры:</b>\n"
-                    "• <code>Мой Minecraft Сервер</code>\n"
-                    "• <code>https://myserver.com</code>\n"
-                    "• <code>Discord сервер</code>\n"
-                    "• <code>t.me/mychannel</code>",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
-        return True
+    except Exception as e:
+        send_message(user_id,
+                    f"❌ <b>Ошибка сохранения!</b>\n\n"
+                    f"Причина: {str(e)}\n\n"
+                    "Попробуйте ввести название снова:",
+                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}]])
     
-    elif data == "create_status_message":
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-        conn.close()
-        
-        if user:
-            status_text = generate_status_text(user_id, "status_unknown")
-            if send_new_status_message(user_id, status_text):
-                edit_message(user_id, message_id,
-                            "✅ <b>Сообщение создано!</b>\n\n"
-                            "Бот создал новое сообщение для статуса в вашей группе.\n"
-                            "Теперь вы можете управлять статусом сервера.",
-                            get_main_menu_buttons())
-            else:
-                edit_message(user_id, message_id,
-                            "❌ <b>Ошибка создания сообщения</b>\n\n"
-                            "Проверьте права бота в группе.",
-                            get_main_menu_buttons())
+    return True
+
+@state_route("waiting_broadcast")
+@admin_required
+def state_broadcast(user_id, text):
+    job_id = broadcast_message(text)
+    send_message(user_id, 
+                f"✅ Рассылка #{job_id} запущена!\n\n"
+                "Прогресс можно посмотреть в админ-панели.",
+                buttons=get_admin_buttons())
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_timezone")
+def state_timezone(user_id, text):
+    try:
+        # pytz и zoneinfo сообщают о неизвестном поясе KeyError, о кривом имени - ValueError
+        get_timezone(text)
+    except (KeyError, ValueError):
+        send_message(user_id, "❌ Неверный часовой пояс. Используйте формат: Europe/Moscow", buttons=get_settings_buttons(user_id))
+        user_states.set(user_id, None)
         return True
     
-    elif data.startswith("status_"):
-        success = update_server_status(user_id, data)
+    try:
+        db_writer.execute('UPDATE users SET timezone = ? WHERE user_id = ?', (text, user_id)).result()
+        invalidate_user(user_id)
+        send_message(user_id, f"✅ Часовой пояс изменен на: {text}", buttons=get_settings_buttons(user_id))
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения часового пояса {user_id}: {e}")
+        send_message(user_id, "❌ Не удалось сохранить часовой пояс, попробуйте позже", buttons=get_settings_buttons(user_id))
+    
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_group_message")
+def state_group_message(user_id, text):
+    user = get_user(user_id)
+    
+    if user:
+        result = send_message(
+            user['group_id'], 
+            text,
+            thread_id=user['thread_id'] if user['thread_id'] else None
+        )
         
-        if success:
-            status_names = {
-                "status_on": "🟢 ВКЛЮЧЕН",
-                "status_pause": "🟡 ПРИОСТАНОВЛЕН", 
-                "status_off": "🔴 ВЫКЛЮЧЕН",
-                "status_unknown": "❓ НЕИЗВЕСТНО"
-            }
-            edit_message(user_id, message_id,
-                        f"✅ <b>Статус обновлен!</b>\n\n"
-                        f"Новый статус: {status_names.get(data, 'Неизвестно')}\n"
-                        f"⏰ Время: {get_current_time(user_id)}",
-                        get_main_menu_buttons())
+        if result and result.get('ok'):
+            send_message(user_id, "✅ Сообщение успешно отправлено в группу!", buttons=get_main_menu_buttons())
         else:
-            edit_message(user_id, message_id,
-                        "❌ <b>Сообщение не найдено!</b>\n\n"
-                        "Бот не может найти сообщение для редактирования.\n"
-                        "Возможно, сообщение было удалено или не настроено.\n\n"
-                        "Создайте новое сообщение для статуса:",
-                        get_create_message_buttons())
-        return True
+            send_message(user_id, "❌ Не удалось отправить сообщение. Проверьте права бота.", buttons=get_main_menu_buttons())
+    else:
+        send_message(user_id, "❌ Ошибка: данные группы не найдены.", buttons=get_main_menu_buttons())
     
-    elif data == "admin_panel":
-        if int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-            show_admin_panel(user_id, message_id)
-        else:
-            send_message(user_id, "❌ Доступ запрещен или требуется аутентификация")
-        return True
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_disable_reason")
+@admin_required
+def state_disable_reason(user_id, text):
+    set_bot_status(False, text)
+    send_message(user_id, f"🔴 Бот выключен. Причина: {text}", buttons=get_admin_buttons())
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_server_info")
+def state_server_info(user_id, text):
+    db_writer.execute('UPDATE users SET server_info = ? WHERE user_id = ?', (text, user_id)).result()
+    invalidate_user(user_id)
     
-    elif data == "admin_users" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-        show_all_users(user_id, message_id)
-        return True
+    send_message(user_id, 
+                f"✅ Название/ссылка успешно изменена!\n\n"
+                f"Теперь в статусе будет отображаться: <b>{text}</b>",
+                buttons=get_settings_buttons(user_id))
+    
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_admin_password")
+def state_admin_password(user_id, text):
+    if authenticate_admin(user_id, text):
+        send_message(user_id, "✅ <b>Доступ разрешен!</b>\n\nДобро пожаловать в админ-панель!", buttons=get_admin_buttons())
+        show_admin_panel(user_id)
+    else:
+        send_message(user_id, "❌ <b>Неверный пароль!</b>\n\nПопробуйте еще раз или вернитесь в меню.", 
+                   [[{"text": "🔐 Попробовать снова", "callback_data": "admin_login"}],
+                    [{"text": "🔙 В главное меню", "callback_data": "back_to_main"}]])
+    
+    user_states.set(user_id, None)
+    return True
+
+@state_route("waiting_group_id_for_setup")
+def state_group_id_for_setup(user_id, text):
+    try:
+        group_id = int(text)
         
-    elif data == "admin_broadcast" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-        user_states[user_id] = "waiting_broadcast"
-        edit_message(user_id, message_id,
-                    "📢 <b>Рассылка сообщения</b>\n\n"
-                    "Введите текст для рассылки всем пользователям:",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "admin_panel"}]])
-        return True
+        if group_id >= 0:
+            send_message(user_id,
+                        "❌ <b>Неверный ID группы!</b>\n\n"
+                        "ID группы должен быть отрицательным числом (начинаться с -100).\n\n"
+                        "Примеры правильных ID:\n"
+                        "• <code>-100123456789</code>\n"
+                        "• <code>-100987654321</code>\n\n"
+                        "Попробуйте снова:",
+                        get_retry_setup_buttons())
+            user_states.set(user_id, None)
+            return True
         
-    elif data == "admin_manage_bot" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-        show_bot_management(user_id, message_id)
-        return True
+        success, result = create_and_setup_message(user_id, group_id)
         
-    elif data == "admin_enable_bot" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-        set_bot_status(True, "")
-        show_bot_management(user_id, message_id)
-        send_message(user_id, "✅ Бот включен!")
-        return True
+        if success:
+            send_message(user_id,
+                        f"✅ <b>Автонастройка завершена!</b>\n\n"
+                        f"📋 Группа ID: {group_id}\n"
+                        f"💬 Создано сообщение: {result}\n\n"
+                        f"🤖 Бот автоматически настроен и готов к работе!",
+                        buttons=get_main_menu_buttons())
+            user_states.set(user_id, None)
+        else:
+            send_message(user_id,
+                        f"❌ <b>Ошибка автонастройки!</b>\n\n"
+                        f"{result}\n\n"
+                        "Выберите действие:",
+                        get_retry_setup_buttons())
+            user_states.set(user_id, None)
         
-    elif data == "admin_disable_bot" and int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
-        user_states[user_id] = "waiting_disable_reason"
-        edit_message(user_id, message_id,
-                    "🔴 <b>Выключение бота</b>\n\n"
-                    "Введите причину выключения:",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "admin_manage_bot"}]])
-        return True
+    except ValueError:
+        send_message(user_id, 
+                    "❌ <b>Неверный формат!</b>\n\n"
+                    "ID группы должен быть числом.\n"
+                    "Пример: <code>-100123456789</code>\n\n"
+                    "Попробуйте снова:",
+                    get_retry_setup_buttons())
+        user_states.set(user_id, None)
+    except Exception as e:
+        send_message(user_id, 
+                    f"❌ <b>Неизвестная ошибка!</b>\n\n"
+                    f"Причина: {str(e)}\n\n"
+                    "Попробуйте снова:",
+                    get_retry_setup_buttons())
+        user_states.set(user_id, None)
     
-    elif data == "start_setup":
-        user_states[user_id] = "waiting_group_settings"
-        edit_message(user_id, message_id,
-                    "🤖 <b>Настройка группы</b>\n\n"
-                    "Отправьте данные в формате:\n"
-                    "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
-                    "📝 <b>Пример:</b>\n"
-                    "<code>-100123456789,10,123,Мой Сервер</code>\n\n"
-                    "ℹ️ <i>Если темы нет, оставьте thread_id пустым:</i>\n"
-                    "<code>-100123456789,,123,Мой Сервер</code>",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
-        return True
+    return True
+
+@command_route("/start")
+def command_start(user_id, text):
+    reset_user_settings(user_id)
+    
+    welcome_text = (
+        "🔄 <b>Бот полностью перезагружен!</b>\n\n"
+        "🤖 <b>Добро пожаловать в бот управления статусами!</b>\n\n"
+        "📋 <b>Выберите способ настройки:</b>\n\n"
+        "🚀 <b>Быстрая настройка</b> (рекомендуется):\n"
+        "• Бот сам создаст сообщение в группе\n"
+        "• Автоматическая настройка\n"
+        "• Просто укажите ID группы\n\n"
+        "📋 <b>Ручная настройка</b>:\n"
+        "• Полный контроль над настройками\n"
+        "• Указание всех параметров вручную\n\n"
+        "💡 <b>Что можно отслеживать?</b>\n"
+        "• Серверы (Minecraft, Discord и др.)\n"
+        "• Сайты и приложения\n" 
+        "• Telegram каналы и боты\n"
+        "• Любые другие объекты!"
+    )
     
-    elif data == "help_thread_id":
-        help_text = (
-            "🔍 <b>Как найти данные?</b>\n\n"
-            "1. <b>group_id</b> - ID группы:\n"
-            "   • Добавьте @RawDataBot в группу\n"
-            "   • Он покажет ID группы (начинается с -100)\n\n"
-            "2. <b>message_id</b> - ID сообщения:\n"
-            "   • Перешлите сообщение в @RawDataBot\n"
-            "   • Он покажет ID сообщения\n\n"
-            "3. <b>thread_id</b> - ID темы:\n"
-            "   • Откройте тему в веб-версии\n"
-            "   • Посмотрите в URL: t.me/c/.../<b>123</b>\n"
-            "   • Или оставьте пустым для основной темы\n\n"
-            "💡 <b>Примеры правильных данных:</b>\n"
-            "• Без темы: <code>-100123456789,,123,Мой Сервер</code>\n"
-            "• С темой: <code>-100123456789,10,123,Мой Сервер</code>"
-        )
-        edit_message(user_id, message_id, help_text, 
-                    [[{"text": "🔄 Начать настройку", "callback_data": "start_setup"}],
-                     [{"text": "🔙 Назад", "callback_data": "restart_setup"}]])
-        return True
+    send_message(user_id, welcome_text, get_welcome_buttons())
+    logger.info(f"🔄 Пользователь {user_id} выполнил /start")
+    return True
+
+@command_route("/admin")
+def command_admin(user_id, text):
+    if int(user_id) == int(ADMIN_USER_ID):
+        if is_admin_authenticated(user_id):
+            show_admin_panel(user_id)
+            logger.info(f"👑 Админ {user_id} открыл панель")
+        else:
+            user_states.set(user_id, "waiting_admin_password")
+            send_message(user_id, 
+                       "🔐 <b>Аутентификация администратора</b>\n\n"
+                       "Введите пароль для доступа к админ-панели:",
+                       [[{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
+    else:
+        send_message(user_id, "❌ <b>Доступ запрещен</b>\n\nЭта команда только для администратора.")
+    return True
+
+@command_route("/stats")
+def command_stats(user_id, text):
+    show_stats(user_id)
+    return True
+
+@command_route("/settings")
+def command_settings(user_id, text):
+    show_settings(user_id)
+    return True
+
+@command_route("/restart", "/reset", "перезапустить", "сбросить")
+def command_reset(user_id, text):
+    reset_user_settings(user_id)
+    send_message(user_id,
+                "🔄 <b>Настройки сброшены!</b>\n\n"
+                "Вы можете начать настройку заново:",
+                get_welcome_buttons())
+    return True
+
+def get_group_name(user_id):
+    user = get_user(user_id)
+    return user['group_name'] if user else 'Неизвестно'
+
+def get_message_id(user_id):
+    user = get_user(user_id)
+    return user['message_id'] if user else 'Неизвестно'
+
+def process_callback(callback):
+    user_id = callback["from"]["id"]
+    data = callback["data"]
+    message_id = callback["message"]["message_id"]
     
-    elif data == "back_to_main":
-        show_main_menu(user_id, message_id)
-        return True
-        
-    elif data == "back_to_settings":
-        show_settings(user_id, message_id)
-        return True
-        
-    elif data == "manage_status":
-        show_status_management(user_id, message_id)
-        return True
-        
-    elif data == "stats":
-        show_stats(user_id, message_id)
-        return True
-        
-    elif data == "settings":
-        show_settings(user_id, message_id)
-        return True
-        
-    elif data == "change_timezone":
-        user_states[user_id] = "waiting_timezone"
+    if not callback.get("answered_inline"):
+        answer_callback(callback["id"], CALLBACK_TOASTS.get(data))
+    
+    handler = callback_routes.get(data)
+    route = data
+    if handler is None:
+        # subscribe_<id>, unsubscribe_<id>, status_<...>: ищем по префиксу до "_"
+        route = data[:data.find("_") + 1]
+        handler = callback_prefix_routes.get(route)
+    if handler:
+        dispatch_route(f"callback:{route}", handler, user_id, message_id, data)
+    return True
+
+@callback_route("restart_setup")
+def callback_restart_setup(user_id, message_id, data):
+    user_states.delete(user_id)
+    
+    edit_message(user_id, message_id,
+                "🔄 <b>Настройка перезапущена!</b>\n\n"
+                "Выберите способ настройки:",
+                get_welcome_buttons())
+    return True
+
+@callback_route("quick_setup")
+def callback_quick_setup(user_id, message_id, data):
+    user_states.set(user_id, "waiting_group_id_for_setup")
+    edit_message(user_id, message_id,
+                "🚀 <b>Быстрая настройка</b>\n\n"
+                "📋 <b>Для автоматической настройки:</b>\n\n"
+                "1. Добавьте бота в вашу группу\n"
+                "2. Дайте боту права администратора\n"
+                "3. Укажите ID группы ниже\n\n"
+                "💡 <b>Как найти ID группы?</b>\n"
+                "• Добавьте @RawDataBot в группу\n"
+                "• Он покажет ID группы (начинается с -100)\n\n"
+                "📝 Введите ID группы:\n\n"
+                "💡 <b>Пример:</b> <code>-100123456789</code>",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
+    return True
+
+@callback_route("admin_login")
+def callback_admin_login(user_id, message_id, data):
+    if int(user_id) == int(ADMIN_USER_ID):
+        user_states.set(user_id, "waiting_admin_password")
         edit_message(user_id, message_id,
-                    "🕐 <b>Изменение часового пояса</b>\n\n"
-                    "Введите ваш часовой пояс (например: Europe/Moscow, Asia/Yekaterinburg):",
+                    "🔐 <b>Аутентификация администратора</b>\n\n"
+                    "Введите пароль для доступа к админ-панели:",
                     [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
                      [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
-        return True
-        
-    elif data == "change_group_settings":
-        user_states[user_id] = "waiting_group_settings"
+    else:
+        send_message(user_id, "❌ Доступ запрещен")
+    return True
+
+@callback_route("admin_logout")
+def callback_admin_logout(user_id, message_id, data):
+    if int(user_id) == int(ADMIN_USER_ID):
+        logout_admin(user_id)
         edit_message(user_id, message_id,
-                    "✏️ <b>Настройки группы</b>\n\n"
-                    "Введите данные в формате:\n"
-                    "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
-                    "Пример:\n"
-                    "<code>-100123456,10,123,Мой Сервер</code>\n\n"
-                    "Если темы нет, оставьте thread_id пустым:\n"
-                    "<code>-100123456,,123,Мой Сервер</code>",
-                    [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
-                     [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
-        return True
+                    "✅ <b>Выход выполнен</b>\n\n"
+                    "Вы вышли из админ-панели.",
+                    get_settings_buttons(user_id))
+    return True
+
+@callback_route("send_message")
+def callback_send_message(user_id, message_id, data):
+    show_send_message_menu(user_id, message_id)
+    return True
+
+@callback_route("history")
+def callback_history(user_id, message_id, data):
+    show_history(user_id, message_id)
+    return True
+
+@callback_route("subscriptions")
+def callback_subscriptions(user_id, message_id, data):
+    show_subscriptions_menu(user_id, message_id)
+    return True
+
+@callback_prefix("subscribe_")
+def callback_subscribe_prefix(user_id, message_id, data):
+    target_user_id = int(data.split("_")[1])
+    if subscribe_to_server(user_id, target_user_id):
+        send_message(user_id, "✅ Вы успешно подписались на сервер!")
+    show_subscriptions_menu(user_id, message_id)
+    return True
+
+@callback_prefix("unsubscribe_")
+def callback_unsubscribe_prefix(user_id, message_id, data):
+    target_user_id = int(data.split("_")[1])
+    if unsubscribe_from_server(user_id, target_user_id):
+        send_message(user_id, "✅ Вы отписались от сервера")
+    show_subscriptions_menu(user_id, message_id)
+    return True
+
+@callback_route("unsubscribe_all")
+def callback_unsubscribe_all(user_id, message_id, data):
+    if unsubscribe_from_all(user_id):
+        send_message(user_id, "✅ Вы отписались от всех серверов")
+    show_subscriptions_menu(user_id, message_id)
+    return True
+
+@callback_route("change_server_info")
+def callback_change_server_info(user_id, message_id, data):
+    user_states.set(user_id, "waiting_server_info")
+    current_info = get_user_server_info(user_id)
+    edit_message(user_id, message_id,
+                f"🔗 <b>Изменение названия/ссылки</b>\n\n"
+                f"Текущее значение: <b>{current_info}</b>\n\n"
+                "Введите новое название или ссылку:\n\n"
+                "💡 <b>Примеры:</b>\n"
+                "• <code>Мой Minecraft Сервер</code>\n"
+                "• <code>https://myserver.com</code>\n"
+                "• <code>Discord сервер</code>\n"
+                "• <code>t.me/mychannel</code>",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
+    return True
+
+@callback_route("create_status_message")
+def callback_create_status_message(user_id, message_id, data):
+    user = get_user(user_id)
+    
+    if user:
+        status_text = generate_status_text(user_id, "status_unknown")
+        if send_new_status_message(user_id, status_text):
+            edit_message(user_id, message_id,
+                        "✅ <b>Сообщение создано!</b>\n\n"
+                        "Бот создал новое сообщение для статуса в вашей группе.\n"
+                        "Теперь вы можете управлять статусом сервера.",
+                        get_main_menu_buttons())
+        else:
+            edit_message(user_id, message_id,
+                        "❌ <b>Ошибка создания сообщения</b>\n\n"
+                        "Проверьте права бота в группе.",
+                        get_main_menu_buttons())
+    return True
+
+@callback_prefix("status_")
+def callback_status_prefix(user_id, message_id, data):
+    success = update_server_status(user_id, data)
     
+    if success:
+        edit_message(user_id, message_id,
+                    f"✅ <b>Статус обновлен!</b>\n\n"
+                    f"Новый статус: {STATUS_LABELS.get(data, 'Неизвестно')}\n"
+                    f"⏰ Время: {get_current_time(user_id)}",
+                    get_main_menu_buttons())
+    else:
+        edit_message(user_id, message_id,
+                    "❌ <b>Сообщение не найдено!</b>\n\n"
+                    "Бот не может найти сообщение для редактирования.\n"
+                    "Возможно, сообщение было удалено или не настроено.\n\n"
+                    "Создайте новое сообщение для статуса:",
+                    get_create_message_buttons())
+    return True
+
+@callback_route("admin_panel")
+def callback_admin_panel(user_id, message_id, data):
+    if int(user_id) == int(ADMIN_USER_ID) and is_admin_authenticated(user_id):
+        show_admin_panel(user_id, message_id)
+    else:
+        send_message(user_id, "❌ Доступ запрещен или требуется аутентификация")
+    return True
+
+@callback_route("admin_users")
+@admin_required
+def callback_admin_users(user_id, message_id, data):
+    show_all_users(user_id, message_id)
+    return True
+
+@callback_route("admin_broadcast")
+@admin_required
+def callback_admin_broadcast(user_id, message_id, data):
+    user_states.set(user_id, "waiting_broadcast")
+    edit_message(user_id, message_id,
+                "📢 <b>Рассылка сообщения</b>\n\n"
+                "Введите текст для рассылки всем пользователям:",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "admin_panel"}]])
+    return True
+
+@callback_route("admin_broadcast_status")
+@admin_required
+def callback_admin_broadcast_status(user_id, message_id, data):
+    edit_message(user_id, message_id,
+                format_broadcast_progress(get_latest_broadcast_job()),
+                [[{"text": "🔄 Обновить", "callback_data": "admin_broadcast_status"}],
+                 [{"text": "🔙 Назад", "callback_data": "admin_panel"}]])
+    return True
+
+@callback_route("admin_manage_bot")
+@admin_required
+def callback_admin_manage_bot(user_id, message_id, data):
+    show_bot_management(user_id, message_id)
+    return True
+
+@callback_route("admin_enable_bot")
+@admin_required
+def callback_admin_enable_bot(user_id, message_id, data):
+    set_bot_status(True, "")
+    show_bot_management(user_id, message_id)
+    send_message(user_id, "✅ Бот включен!")
+    return True
+
+@callback_route("admin_disable_bot")
+@admin_required
+def callback_admin_disable_bot(user_id, message_id, data):
+    user_states.set(user_id, "waiting_disable_reason")
+    edit_message(user_id, message_id,
+                "🔴 <b>Выключение бота</b>\n\n"
+                "Введите причину выключения:",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "admin_manage_bot"}]])
+    return True
+
+@callback_route("start_setup")
+def callback_start_setup(user_id, message_id, data):
+    user_states.set(user_id, "waiting_group_settings")
+    edit_message(user_id, message_id,
+                "🤖 <b>Настройка группы</b>\n\n"
+                "Отправьте данные в формате:\n"
+                "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
+                "📝 <b>Пример:</b>\n"
+                "<code>-100123456789,10,123,Мой Сервер</code>\n\n"
+                "ℹ️ <i>Если темы нет, оставьте thread_id пустым:</i>\n"
+                "<code>-100123456789,,123,Мой Сервер</code>",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "back_to_main"}]])
+    return True
+
+@callback_route("help_thread_id")
+def callback_help_thread_id(user_id, message_id, data):
+    help_text = (
+        "🔍 <b>Как найти данные?</b>\n\n"
+        "1. <b>group_id</b> - ID группы:\n"
+        "   • Добавьте @RawDataBot в группу\n"
+        "   • Он покажет ID группы (начинается с -100)\n\n"
+        "2. <b>message_id</b> - ID сообщения:\n"
+        "   • Перешлите сообщение в @RawDataBot\n"
+        "   • Он покажет ID сообщения\n\n"
+        "3. <b>thread_id</b> - ID темы:\n"
+        "   • Откройте тему в веб-версии\n"
+        "   • Посмотрите в URL: t.me/c/.../<b>123</b>\n"
+        "   • Или оставьте пустым для основной темы\n\n"
+        "💡 <b>Примеры правильных данных:</b>\n"
+        "• Без темы: <code>-100123456789,,123,Мой Сервер</code>\n"
+        "• С темой: <code>-100123456789,10,123,Мой Сервер</code>"
+    )
+    edit_message(user_id, message_id, help_text, 
+                [[{"text": "🔄 Начать настройку", "callback_data": "start_setup"}],
+                 [{"text": "🔙 Назад", "callback_data": "restart_setup"}]])
+    return True
+
+@callback_route("back_to_main")
+def callback_back_to_main(user_id, message_id, data):
+    show_main_menu(user_id, message_id)
+    return True
+
+@callback_route("back_to_settings")
+def callback_back_to_settings(user_id, message_id, data):
+    show_settings(user_id, message_id)
+    return True
+
+@callback_route("manage_status")
+def callback_manage_status(user_id, message_id, data):
+    show_status_management(user_id, message_id)
+    return True
+
+@callback_route("stats")
+def callback_stats(user_id, message_id, data):
+    show_stats(user_id, message_id)
+    return True
+
+@callback_route("settings")
+def callback_settings(user_id, message_id, data):
+    show_settings(user_id, message_id)
+    return True
+
+@callback_route("change_timezone")
+def callback_change_timezone(user_id, message_id, data):
+    user_states.set(user_id, "waiting_timezone")
+    edit_message(user_id, message_id,
+                "🕐 <b>Изменение часового пояса</b>\n\n"
+                "Введите ваш часовой пояс (например: Europe/Moscow, Asia/Yekaterinburg):",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
+    return True
+
+@callback_route("change_group_settings")
+def callback_change_group_settings(user_id, message_id, data):
+    user_states.set(user_id, "waiting_group_settings")
+    edit_message(user_id, message_id,
+                "✏️ <b>Настройки группы</b>\n\n"
+                "Введите данные в формате:\n"
+                "<code>group_id,thread_id,message_id,название_группы</code>\n\n"
+                "Пример:\n"
+                "<code>-100123456,10,123,Мой Сервер</code>\n\n"
+                "Если темы нет, оставьте thread_id пустым:\n"
+                "<code>-100123456,,123,Мой Сервер</code>",
+                [[{"text": "🔄 Начать заново", "callback_data": "restart_setup"}],
+                 [{"text": "🔙 Отмена", "callback_data": "back_to_settings"}]])
     return True
 
 def show_main_menu(user_id, message_id=None):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = get_user(user_id)
     
     if user:
-        server_info = get_user_server_info(user_id)
-        text = (
-            f"🤖 <b>Управление статусами</b>\n\n"
-            f"🏷️ <b>Текущий объект:</b> {server_info}\n"
-            f"📋 Группа: {user['group_name']}\n"
-            f"💬 Сообщение: {user['message_id'] if user['message_id'] else '❌ Не создано'}\n"
-            f"🏷️ Тема: {user['thread_id'] if user['thread_id'] else 'Нет'}\n"
-            f"⏰ Часовой пояс: {user['timezone']}\n\n"
-            f"<b>Доступные функции:</b>\n"
-            "• ⚡ Управление статусом\n"
-            "• 📝 Отправка сообщений в группу\n" 
-            "• 📊 Просмотр статистики\n"
-            "• 📈 История изменений\n"
-            "• 🔔 Управление подписками\n"
-            "• ⚙️ Настройки\n\n"
-            f"⏰ Ваше время: {get_current_time(user_id)}"
+        text = render_main_menu(
+            server_info=user['server_info'],
+            group_name=user['group_name'],
+            message=user['message_id'] if user['message_id'] else '❌ Не создано',
+            thread=user['thread_id'] if user['thread_id'] else 'Нет',
+            timezone=user['timezone'],
+            time=get_current_time(user_id)
         )
     else:
-        text = "❌ <b>Бот не настроен</b>\n\nИспользуйте настройки для конфигурации"
+        text = MAIN_MENU_NOT_CONFIGURED_TEXT
     
     if message_id:
         edit_message(user_id, message_id, text, get_main_menu_buttons())
@@ -1162,16 +3200,14 @@ def show_main_menu(user_id, message_id=None):
         send_message(user_id, text, get_main_menu_buttons())
 
 def show_status_management(user_id, message_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = get_user(user_id)
     
     if not user:
         text = "❌ <b>Сначала настройте группу!</b>\n\nПерейдите в настройки и укажите данные вашей группы."
-        edit_message(user_id, message_id, text, [[{"text": "⚙️ Настройки", "callback_data": "settings"}]])
+        edit_message(user_id, message_id, text, SETTINGS_ONLY_BUTTONS)
         return
     
-    server_info = get_user_server_info(user_id)
+    server_info = user['server_info']
     
     if not user['message_id']:
         text = (
@@ -1179,18 +3215,16 @@ def show_status_management(user_id, message_id):
             f"Для управления статусом {server_info} нужно сообщение в группе.\n\n"
             "Выберите действие:"
         )
-        buttons = [
-            [{"text": "📝 Создать сообщение", "callback_data": "create_status_message"}],
-            [{"text": "⚙️ Настроить сообщение", "callback_data": "change_group_settings"}],
-            [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
-        ]
+        buttons = MISSING_MESSAGE_BUTTONS
     else:
         text = (
             f"⚡ <b>Управление статусом {server_info}</b>\n\n"
             f"Группа: {user['group_name']}\n"
             f"Сообщение: {user['message_id']}\n"
             f"Тема: {user['thread_id'] if user['thread_id'] else 'Нет'}\n"
-            f"Подписчиков: {get_subscriber_count(user_id)}\n\n"
+            f"Текущий статус: {STATUS_LABELS.get(get_current_status(user_id), 'Не задан')}\n"
+            f"Подписчиков: {get_subscriber_count(user_id)}\n"
+            f"{format_fanout_progress(fanout_progress.get(user_id))}\n"
             "Выберите новый статус:"
         )
         buttons = get_status_buttons()
@@ -1199,61 +3233,253 @@ def show_status_management(user_id, message_id):
 
 def show_stats(user_id, message_id=None):
     conn = get_db_connection()
-    latest_statuses = conn.execute('''
-        SELECT ss.user_id, ss.status, u.group_name, u.server_info
-        FROM server_statuses ss
-        INNER JOIN (
-            SELECT user_id, MAX(created_at) as max_date
-            FROM server_statuses
-            GROUP BY user_id
-        ) latest ON ss.user_id = latest.user_id AND ss.created_at = latest.max_date
-        INNER JOIN users u ON ss.user_id = u.user_id
-    ''').fetchall()
-    conn.close()
-    
-    stats = {"status_on": 0, "status_pause": 0, "status_off": 0, "status_unknown": 0}
-    for status in latest_statuses:
-        if status['status'] in stats:
-            stats[status['status']] += 1
+    counters = conn.execute('SELECT status, count FROM status_counters').fetchall()
     
-    total = sum(stats.values())
+    stats = dict.fromkeys(STATUS_EMOJIS, 0)
+    for counter in counters:
+        if counter['status'] in stats:
+            stats[counter['status']] = counter['count']
     
-    status_emojis = {
-        "status_on": "🟢",
-        "status_pause": "🟡",
-        "status_off": "🔴", 
-        "status_unknown": "❓"
-    }
-    
-    status_text = ""
-    for status, count in stats.items():
-        emoji = status_emojis.get(status, "❓")
-        status_text += f"{emoji} {count}\n"
+    text = render_stats(
+        total=sum(stats.values()),
+        status_text="".join(f"{STATUS_EMOJIS[status]} {count}\n" for status, count in stats.items()),
+        time=get_current_time(user_id)
+    )
     
+    if message_id:
+        edit_message(user_id, message_id, text, get_back_button())
+    else:
+        send_message(user_id, text, get_back_button())
+
+def show_admin_panel(user_id, message_id=None):
     text = (
-        "📊 <b>Глобальная статистика</b>\n\n"
-        f"Всего объектов: {total}\n\n"
-        f"Статусы:\n{status_text}\n"
-        f"⏰ Обновлено: {get_current_time(user_id)}"
+        "👑 <b>Админ-панель</b>\n\n"
+        f"🤖 Бот: {'🟢 включен' if bot_enabled else f'🔴 выключен ({bot_disable_reason})'}\n"
+        f"⏱️ Аптайм: {int(time.time() - bot_start_time) // 60} мин\n"
+        f"🗃️ Кэш профилей: {user_cache.stats()['hit_rate']:.0%} попаданий\n\n"
+        f"{format_broadcast_progress(get_latest_broadcast_job())}"
     )
     
     if message_id:
-        edit_message(user_id, message_id, text, [[{"text": "🔙 Назад", "callback_data": "back_to_main"}]])
+        edit_message(user_id, message_id, text, get_admin_buttons())
     else:
+        send_message(user_id, text, get_admin_buttons())
+
+# ========== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ==========
+# Обновления шардируются по чату: внутри одного чата порядок строгий,
+# разные чаты обрабатываются параллельно разными воркерами
+update_shards = [queue.Queue(maxsize=max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)) for _ in range(UPDATE_WORKERS)]
+update_workers = []
+update_workers_lock = Lock()
+
+# ========== ДОСТАВКА ОБНОВЛЕНИЙ ==========
+# Telegram хранит обновления сутки и после падения отдает их повторно,
+# а вебхук повторяет доставку при таймауте. Перед обработкой update_id
+# заявляется в processed_updates (INSERT OR IGNORE): повтор из любого
+# процесса пропускается. Окно ограничено по времени и по числу id.
+# Offset polling подтверждается только до самого раннего обновления,
+# которое еще в очереди или в обработке, и пишется в базу пачкой раз в
+# UPDATE_CHECKPOINT_INTERVAL. getUpdates запрашивается с него же, поэтому
+# Telegram держит необработанные обновления и после падения отдаст их снова;
+# уже поставленные в очередь опрос пропускает. Обновление, упавшее
+# посреди обработки, не повторяется
+UPDATE_DEDUP_PRUNE_INTERVAL = 300
+
+class UpdateTracker:
+    def __init__(self, name="polling", interval=UPDATE_CHECKPOINT_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.lock = Lock()
+        self.progress = threading.Condition(self.lock)
+        self.in_flight = set()
+        self.received = 0
+        self.saved = 0
+        self.last_prune = 0
+        self.started = False
+    
+    def load_offset(self):
+        row = get_db_connection().execute(
+            'SELECT update_id FROM update_offsets WHERE name = ?', (self.name,)
+        ).fetchone()
+        with self.lock:
+            self.saved = self.received = max(self.received, row[0] if row else 0)
+        return self.received
+    
+    def track(self, update_id):
+        # Обновление получено опросом; False - оно уже в очереди или обработано
+        with self.lock:
+            if update_id <= self.received:
+                return False
+            self.in_flight.add(update_id)
+            self.received = update_id
+            if not self.started:
+                self.started = True
+                Thread(target=self.run, name="update-checkpoint", daemon=True).start()
+            return True
+    
+    def finish(self, update_id):
+        with self.lock:
+            self.in_flight.discard(update_id)
+            self.progress.notify_all()
+    
+    def confirmed_offset(self):
+        with self.lock:
+            return min(self.in_flight) - 1 if self.in_flight else self.received
+    
+    def wait_progress(self, offset, timeout):
+        # Опрос вернул только уже взятые обновления: ждем, пока offset сдвинется
+        with self.progress:
+            self.progress.wait_for(lambda: not self.in_flight or min(self.in_flight) - 1 > offset, timeout)
+    
+    @staticmethod
+    def insert_claim(conn, update_id, claimed_at):
+        return conn.execute(
+            'INSERT OR IGNORE INTO processed_updates (update_id, claimed_at) VALUES (?, ?)',
+            (update_id, claimed_at)
+        ).rowcount
+    
+    def claim(self, update_id):
+        # Отметки параллельных обновлений фиксируются писателем одной пачкой
+        try:
+            return db_writer.call(self.insert_claim, update_id, time.time()).result() > 0
+        except Exception as e:
+            # Без базы обновление лучше обработать, чем потерять
+            logger.error(f"Ошибка отметки обновления {update_id}: {e}")
+            return True
+    
+    @staticmethod
+    def prune_claims(conn, now):
+        conn.execute('DELETE FROM processed_updates WHERE claimed_at < ?', (now - UPDATE_DEDUP_TTL,))
+        conn.execute(
+            'DELETE FROM processed_updates WHERE update_id <= (SELECT MAX(update_id) FROM processed_updates) - ?',
+            (UPDATE_DEDUP_LIMIT,)
+        )
+    
+    def checkpoint(self):
+        offset = self.confirmed_offset()
+        try:
+            if offset > self.saved:
+                # Другой процесс при выкатке мог уйти дальше: offset не откатываем
+                db_writer.execute('''
+                    INSERT INTO update_offsets (name, update_id) VALUES (?, ?)
+                    ON CONFLICT (name) DO UPDATE SET update_id = MAX(update_id, excluded.update_id)
+                ''', (self.name, offset)).result()
+                self.saved = offset
+            
+            now = time.time()
+            if now - self.last_prune >= UPDATE_DEDUP_PRUNE_INTERVAL:
+                self.last_prune = now
+                db_writer.call(self.prune_claims, now).result()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения offset: {e}")
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.checkpoint()
+
+update_tracker = UpdateTracker()
+
+def process_update(update, received_at=None):
+    # received_at - момент постановки в очередь (time.monotonic())
+    received_at = received_at or time.monotonic()
+    update_id = update.get("update_id")
+    update_type = "other"
+    token = current_update.set(UpdateContext(get_update_user_id(update)))
+    try:
+        if update_id is not None and not update_tracker.claim(update_id):
+            logger.info(f"🔁 Обновление {update_id} уже обработано, пропускаем")
+            return
+        if "message" in update:
+            update_type = "message"
+            process_message(update["message"])
+        elif "callback_query" in update:
+            update_type = "callback_query"
+            process_callback(update["callback_query"])
+    except Exception as e:
+        logger.error(f"💥 Ошибка обработки обновления {update.get('update_id')}: {e}")
+    finally:
+        current_update.reset(token)
+        rollback_db_connection()
+        if update_id is not None:
+            update_tracker.finish(update_id)
+        update_latency.observe(time.monotonic() - received_at, update_type)
+
+def get_update_chat_id(update):
+    try:
+        if "callback_query" in update:
+            return update["callback_query"]["from"]["id"]
+        if "message" in update:
+            return update["message"]["chat"]["id"]
+    except (KeyError, TypeError):
+        pass
+    return update.get("update_id", 0)
+
+def get_update_queue_depth():
+    return sum(shard.qsize() for shard in update_shards)
+
+def update_worker(shard):
+    while True:
+        update, received_at = shard.get()
+        try:
+            process_update(update, received_at)
+        except Exception as e:
+            # Поток шарда не должен умирать: иначе все его чаты зависнут
+            logger.error(f"💥 Ошибка воркера обновлений: {e}")
+        finally:
+            shard.task_done()
 
-        send_message(user_id, text, [[{"text": "🔙 Назад", "callback_data": "back_to_main"}]])
+def start_update_workers():
+    # Воркеры стартуют лениво, уже внутри процесса gunicorn после fork
+    with update_workers_lock:
+        if update_workers:
+            return
+        for i, shard in enumerate(update_shards):
+            worker = Thread(target=update_worker, args=(shard,), name=f"update-worker-{i}", daemon=True)
+            worker.start()
+            update_workers.append(worker)
+    logger.info(f"👷 Запущено воркеров обновлений: {UPDATE_WORKERS}")
+
+def enqueue_update(update, block=False):
+    start_update_workers()
+    shard = update_shards[get_update_chat_id(update) % len(update_shards)]
+    try:
+        shard.put((update, time.monotonic()), block=block)
+        return True
+    except queue.Full:
+        return False
+
+def setup_webhook():
+    result = safe_request(
+        api_url("setWebhook"),
+        {
+            "url": WEBHOOK_URL,
+            "secret_token": WEBHOOK_SECRET,
+            "allowed_updates": ["message", "callback_query"],
+            "max_connections": 100
+        },
+        "POST"
+    )
+    if result and result.get('ok'):
+        logger.info(f"✅ Webhook установлен: {WEBHOOK_URL}")
+    else:
+        logger.error(f"❌ Не удалось установить webhook: {result}")
 
 # ========== ЗАПУСК В РЕЖИМЕ POLLING ==========
 def run_polling_bot():
     logger.info("🤖 Бот запущен в режиме polling...")
-    last_update_id = 0
+    start_update_workers()
+    offset = update_tracker.load_offset()
+    if offset:
+        logger.info(f"📍 Продолжаем опрос с обновления {offset + 1}")
     
-    while True:
+    while not polling_stop.is_set():
         try:
             # Получаем обновления от Telegram
+            offset = update_tracker.confirmed_offset()
             data = safe_request(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates",
-                {"offset": last_update_id + 1, "timeout": 30, "limit": 10},
+                api_url("getUpdates"),
+                {"offset": offset + 1, "timeout": 30, "limit": 100},
                 "POST",
                 timeout=35
             )
@@ -1262,22 +3488,305 @@ def run_polling_bot():
                 updates = data["result"]
                 
                 if updates:
-                    logger.info(f"📨 Получено обновлений: {len(updates)}")
-                
-                for update in updates:
-                    last_update_id = update["update_id"]
-                    process_update(update)
+                    logger.info(f"📨 Получено обновлений: {len(updates)}, в очереди: {get_update_queue_depth()}")
                 
-                time.sleep(0.5)
+                # Блокирующая постановка в очередь дает обратное давление:
+                # пока шард чата переполнен, новые обновления не запрашиваются
+                fresh = [update for update in updates if update_tracker.track(update["update_id"])]
+                for update in fresh:
+                    enqueue_update(update, block=True)
+                if updates and not fresh:
+                    update_tracker.wait_progress(offset, 1)
             else:
                 time.sleep(2)
                 
         except Exception as e:
             logger.error(f"💥 Ошибка в polling цикле: {e}")
             time.sleep(5)
+    
+    update_tracker.checkpoint()
+
+# ========== ASYNCIO-РЕЖИМ ==========
+# Включается через RUNTIME_MODE=asyncio. Все обращения к Bot API идут через
+# асинхронный клиент с keep-alive соединениями, поэтому тысячи запросов
+# (рассылки, уведомления подписчиков) висят в одном цикле событий без потока на запрос:
+# планировщик исходящих сообщений в этом режиме отправляет их корутинами.
+# Обработчики с SQLite остаются блокирующими и выполняются в ограниченном пуле
+class AsyncHTTPConnectionPool:
+    def __init__(self, scheme, host, port, size=HTTP_POOL_SIZE, max_connections=ASYNC_MAX_CONNECTIONS,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, idle_timeout=HTTP_IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.host = host
+        self.port = port or (443 if scheme == "https" else 80)
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+        self.ssl_context = ssl.create_default_context() if scheme == "https" else None
+    
+    async def acquire(self):
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][2] >= self.idle_timeout:
+            _, writer, _ = self.idle.pop(0)
+            writer.close()
+        if self.idle:
+            reader, writer, _ = self.idle.pop()
+            return reader, writer, True
+        return await self.new_connection()
+    
+    async def new_connection(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl_context),
+            self.connect_timeout
+        )
+        return reader, writer, False
+    
+    def close_idle(self):
+        for _, writer, _ in self.idle:
+            writer.close()
+        self.idle = []
+    
+    def release(self, reader, writer, reusable):
+        if reusable and len(self.idle) < self.size:
+            self.idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+    
+    async def exchange(self, reader, writer, method, path, body, headers):
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", "Connection: keep-alive",
+                f"Content-Length: {len(body) if body else 0}"]
+        head.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + (body or b""))
+        await writer.drain()
+        
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("соединение закрыто сервером")
+        version, status = status_line.split(None, 2)[:2]
+        
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        
+        keep_alive = version == b"HTTP/1.1" and response_headers.get("connection", "").lower() != "close"
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b"".join(chunks)
+        elif "content-length" in response_headers:
+            data = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return int(status), data, keep_alive
+    
+    async def request(self, method, path, body=None, headers=None, timeout=HTTP_READ_TIMEOUT):
+        async with self.slots:
+            for attempt in range(2):
+                # Повтор только на новом соединении, как в HTTPConnectionPool
+                reader, writer, reused = await (self.acquire() if attempt == 0 else self.new_connection())
+                reusable = False
+                try:
+                    status, data, reusable = await asyncio.wait_for(
+                        self.exchange(reader, writer, method, path, body, headers or {}), timeout)
+                    return status, data
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    if reused:
+                        self.close_idle()
+                        continue
+                    raise
+                finally:
+                    self.release(reader, writer, reusable)
+
+async_http_pools = {}
+
+def get_async_http_pool(scheme, host, port):
+    key = (scheme, host, port)
+    if key not in async_http_pools:
+        async_http_pools[key] = AsyncHTTPConnectionPool(scheme, host, port)
+    return async_http_pools[key]
+
+async def async_safe_request(url, data=None, method="GET", timeout=HTTP_READ_TIMEOUT):
+    start = time.perf_counter()
+    status = "error"
+    try:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        
+        method, body, headers = encode_request_body(data, method)
+        
+        pool = get_async_http_pool(parts.scheme, parts.hostname, parts.port)
+        status, raw = await pool.request(method, path, body, headers, timeout)
+        result = decode_json(raw)
+        
+        # Тело ошибки возвращается вызывающему: в нем error_code и retry_after
+        if status >= 400:
+            logger.error(f"Ошибка запроса: HTTP {status}: {result.get('description')}")
+        return result
+        
+    except Exception as e:
+        logger.error(f"Ошибка запроса: {e!r}")
+        return None
+    finally:
+        observe_api_request(url, status, time.perf_counter() - start)
+
+async_handler_executor = None
+async_update_shards = []
+
+async def process_update_async(update, received_at=None):
+    await asyncio.get_running_loop().run_in_executor(async_handler_executor, process_update, update, received_at)
+
+async def async_update_worker(shard):
+    while True:
+        update, received_at = await shard.get()
+        try:
+            await process_update_async(update, received_at)
+        except Exception as e:
+            logger.error(f"💥 Ошибка воркера обновлений: {e}")
+        finally:
+            shard.task_done()
+
+def async_enqueue_update(update):
+    shard = async_update_shards[get_update_chat_id(update) % len(async_update_shards)]
+    try:
+        shard.put_nowait((update, time.monotonic()))
+        return True
+    except asyncio.QueueFull:
+        return False
+
+async def run_async_polling():
+    logger.info("🤖 Бот запущен в режиме asyncio polling...")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(async_handler_executor, update_tracker.load_offset)
+    
+    while True:
+        offset = update_tracker.confirmed_offset()
+        data = await async_safe_request(
+            api_url("getUpdates"),
+            {"offset": offset + 1, "timeout": 30, "limit": 100},
+            "POST",
+            timeout=35
+        )
+        
+        if data and data.get("ok"):
+            fresh = [update for update in data["result"] if update_tracker.track(update["update_id"])]
+            for update in fresh:
+                shard = async_update_shards[get_update_chat_id(update) % len(async_update_shards)]
+                await shard.put((update, time.monotonic()))
+            if data["result"] and not fresh:
+                await loop.run_in_executor(None, update_tracker.wait_progress, offset, 1)
+        else:
+            await asyncio.sleep(2)
+
+async def write_http_response(writer, status, reason, body, content_type="text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body
+    )
+    await writer.drain()
+
+async def handle_async_webhook_connection(reader, writer):
+    webhook_path = urllib.parse.urlsplit(WEBHOOK_URL).path or "/webhook"
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target = request_line.decode('latin-1').split()[:2]
+            # Сравниваем только путь: строка запроса на маршрут не влияет
+            path = urllib.parse.urlsplit(target).path
+            
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            
+            length = int(headers.get("content-length", 0))
+            if length > 1024 * 1024:
+                await write_http_response(writer, 413, "Payload Too Large", "Too Large")
+                break
+            body = await reader.readexactly(length) if length else b""
+            
+            if method == "GET" and path == "/":
+                await write_http_response(writer, 200, "OK", "🤖 Бот управления статусами работает!")
+            elif method == "GET" and path == "/metrics":
+                await write_http_response(writer, 200, "OK", render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+            elif method != "POST" or path != webhook_path:
+                await write_http_response(writer, 404, "Not Found", "Not Found")
+            elif not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+                logger.warning("❌ Webhook с неверным секретным токеном")
+                await write_http_response(writer, 403, "Forbidden", "Forbidden")
+            else:
+                try:
+                    update = decode_json(body)
+                except ValueError:
+                    update = None
+                if not isinstance(update, dict):
+                    await write_http_response(writer, 400, "Bad Request", "Bad Request")
+                else:
+                    ack = get_webhook_callback_ack(update)
+                    if not async_enqueue_update(update):
+                        logger.warning("⚠️ Очередь обновлений переполнена")
+                        await write_http_response(writer, 503, "Service Unavailable", "Busy")
+                    elif ack:
+                        await write_http_response(writer, 200, "OK", ack, "application/json")
+                    else:
+                        await write_http_response(writer, 200, "OK", "OK")
+            
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def run_async_bot():
+    global async_loop, async_loop_thread_id, async_handler_executor
+    async_loop = asyncio.get_running_loop()
+    async_loop_thread_id = threading.get_ident()
+    async_handler_executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_WORKERS, thread_name_prefix="async-handler")
+    
+    for i in range(UPDATE_WORKERS):
+        shard = asyncio.Queue(maxsize=max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS))
+        async_update_shards.append(shard)
+        asyncio.create_task(async_update_worker(shard))
+    
+    if WEBHOOK_URL:
+        server = await asyncio.start_server(handle_async_webhook_connection, "0.0.0.0", PORT)
+        await async_loop.run_in_executor(None, setup_webhook)
+        logger.info(f"🤖 Бот запущен в режиме asyncio webhook на порту {PORT}...")
+        async with server:
+            await server.serve_forever()
+    else:
+        await run_async_polling()
+
+start_broadcast_jobs()
+retention_engine.start()
+
+if WEBHOOK_URL and __name__ != "__main__":
+    setup_webhook()
 
 if __name__ == "__main__":
-    run_polling_bot()
+    if RUNTIME_MODE == "asyncio":
+        asyncio.run(run_async_bot())
+    else:
+        run_polling_bot()
 
 
 